@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the byTile job. Generates synthetic days of
+messages, runs `main` on them in local Spark mode with the file data
+source (a bootstrap run followed by incremental runs), and reports the
+time of every run and of the steps `main` times with `Stats.span`.
+
+Run from this folder with pyspark importable, or through spark-submit:
+    python endtoend.py [--messages 100000] [--days 3] [--output endtoend.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+from synthetic import MessageGenerator
+from pyspark import SparkContext
+
+CONTAINERS = ['input', 'prev', 'tiles', 'messages', 'timeseries', 'model']
+
+def setup(root, generator):
+    for container in CONTAINERS:
+        os.makedirs(os.path.join(root, container))
+    generator.write_tables(os.path.join(root, 'input', 'keywords.json'), os.path.join(root, 'input', 'filters.json'))
+    generator.write_sentiment_model(os.path.join(root, 'model', 'sentiment.json'))
+    os.environ.update({
+        'DATA_SOURCE': 'file',
+        'STORAGE_ACCOUNT': '-',
+        'STORAGE_KEY': '-',
+        'INPUT_CONTAINER': os.path.join(root, 'input'),
+        'TILE_PREV_CONTAINER': os.path.join(root, 'prev'),
+        'TILE_OUTPUT_CONTAINER': os.path.join(root, 'tiles'),
+        'MESSAGE_CONTAINER': os.path.join(root, 'messages'),
+        'TIMESERIES_INPUT_PATTERN': '/*/part*',
+        'TIMESERIES_OUTPUT_CONTAINER': os.path.join(root, 'timeseries'),
+        'KEYWORD_TABLE_NAME': 'keywords.json',
+        'FILTER_TABLE_NAME': 'filters.json',
+        'SENTIMENT_CONTAINER': os.path.join(root, 'model'),
+        'SENTIMENT_MODEL': os.path.join(root, 'model', 'sentiment.json'),
+    })
+
+def run_main(sc, day, incremental):
+    os.environ['TILE_INPUT_PATTERN'] = '/%s/*' % day
+    os.environ['INCREMENTAL'] = 'true' if incremental else 'false'
+    start = time.time()
+    job.main(sc)
+    elapsed = time.time() - start
+    stats = job.FileDataSource().loadJson(os.environ['TILE_OUTPUT_CONTAINER'], 'stats.json')
+    if 'Exception' in stats:
+        raise RuntimeError(stats['Exception'])
+    messages = stats.get('valid_tile', 0)
+    # the output folders are named after the second the run started
+    time.sleep(1.1)
+    run = {
+        'day': day,
+        'incremental': incremental,
+        'seconds': elapsed,
+        'valid_messages': messages,
+        'messages_per_second': messages / elapsed if elapsed else 0,
+        'stats': stats,
+    }
+    run['stages'] = stages(run)
+    return run
+
+def stages(run):
+    # the spans `main` timed, slowest first; a span includes the lazy Spark
+    # stages its step is the first to need
+    spans = run['stats'].get('spans', {})
+    return [{
+        'stage': name,
+        'seconds': seconds,
+        'share': seconds / run['seconds'] if run['seconds'] else 0,
+    } for name, seconds in sorted(spans.items(), key=lambda span: -span[1])]
+
+def environment(sc):
+    return {
+        'python': sys.version.split()[0],
+        'spark': getattr(sc, 'version', None),
+        'numpy': job.np != None,
+        'json': 'orjson' if job.orjson != None else 'ujson' if job.ujson != None else 'json',
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100000, help='messages per day')
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--languages', default='en=0.8,ar=0.2', help='language mix, e.g. en=0.8,ar=0.2')
+    parser.add_argument('--keywords', type=int, default=500, help='number of keywords')
+    parser.add_argument('--keywords-per-message', type=float, default=1.5, help='mean number of keywords per message')
+    parser.add_argument('--max-locations', type=int, default=2, help='maximum locations per message')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2, help='share of messages repeating an earlier sentence')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--master', default='local[*]')
+    parser.add_argument('--workdir', default=None, help='folder for the fixtures and outputs, a temporary one by default')
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix='bytile-benchmark-')
+    if os.path.exists(root) and os.listdir(root):
+        raise SystemExit('%s is not empty' % root)
+    generator = MessageGenerator(args.seed, keyword_count=args.keywords, languages=args.languages,
+                                 keywords_per_message=args.keywords_per_message, max_locations=args.max_locations,
+                                 duplicate_ratio=args.duplicate_ratio)
+    setup(root, generator)
+    days = [(date(2016, 5, 1) + timedelta(days=i)).isoformat() for i in range(args.days)]
+    for day in days:
+        generator.write_day(os.environ['INPUT_CONTAINER'], day, args.messages)
+
+    sc = SparkContext(master=args.master, appName='bytile-benchmark')
+    try:
+        runs = []
+        for i, day in enumerate(days):
+            runs.append(run_main(sc, day, i > 0))
+            print '%s %s: %.2f s, %.0f messages/s' % ('incremental' if i > 0 else 'bootstrap', day, runs[-1]['seconds'], runs[-1]['messages_per_second'])
+            for stage in runs[-1]['stages']:
+                print '  %-26s %8.2f s %5.1f%%' % (stage['stage'], stage['seconds'], 100 * stage['share'])
+        results = {
+            'config': vars(args),
+            'environment': environment(sc),
+            'runs': runs,
+        }
+    finally:
+        sc.stop()
+        if not args.workdir:
+            shutil.rmtree(root)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the per-message hot paths of the byTile job.
+
+Run from this folder with the same packages the job uses available:
+    python microbenchmarks.py [--keywords 2000] [--lexicon 10000] [--sentences 2000] [--output results.json]
+
+With --output the results are also written as json, and with --compare
+they are compared against an earlier json file.
+"""
+
+import argparse
+import cPickle
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+from synthetic import random_word, build_vocabulary
+
+RESULTS = {}
+
+def build_keywords(rng, vocabulary, count):
+    # mostly single words, some multi-word phrases and a few with punctuation
+    keywords = {}
+    while len(keywords) < count:
+        roll = rng.random()
+        if roll < 0.7:
+            term = rng.choice(vocabulary)
+        elif roll < 0.95:
+            term = ' '.join(rng.sample(vocabulary, rng.randint(2, 3)))
+        else:
+            term = '%s-%s' % (rng.choice(vocabulary), rng.choice(vocabulary))
+        keywords[term.lower()] = term.title() if rng.random() < 0.3 else term
+    return keywords
+
+def build_sentences(rng, vocabulary, keywords, count, length=20):
+    terms = list(keywords.values())
+    sentences = []
+    for _ in range(count):
+        words = [rng.choice(vocabulary) for _ in range(length)]
+        for _ in range(rng.randint(0, 3)):
+            words.insert(rng.randint(0, len(words)), rng.choice(terms))
+        if rng.random() < 0.3:
+            words.insert(rng.randint(0, len(words)), rng.choice(['!', ',', '...', ':)']))
+        sentences.append(u' '.join(words))
+    return sentences
+
+def timed(fn, items):
+    start = time.time()
+    results = [fn(item) for item in items]
+    return results, time.time() - start
+
+def report(name, elapsed, count):
+    RESULTS[name] = { 'us_per_op': elapsed / count * 1e6, 'ops_per_second': count / elapsed if elapsed else 0 }
+    print '%-40s %10.2f us/op %12.0f ops/s' % (name, elapsed / count * 1e6, count / elapsed if elapsed else 0)
+
+def bench_extract_keywords(args, rng):
+    vocabulary = build_vocabulary(rng, args.vocabulary)
+    terms = build_keywords(rng, vocabulary, args.keywords)
+    sentences = build_sentences(rng, vocabulary, terms, args.sentences)
+
+    regexes = dict((canonical, job.create_keyword_regex(term)) for canonical, term in terms.items())
+    def regex_matches(sentence):
+        return [keyword for keyword in sorted(regexes) if regexes[keyword].search(sentence)]
+
+    matcher = job.PhraseMatcher(terms)
+    def matcher_matches(sentence):
+        return sorted(matcher.matches(sentence))
+
+    expected, regex_elapsed = timed(regex_matches, sentences)
+    actual, matcher_elapsed = timed(matcher_matches, sentences)
+    mismatches = [s for s, e, a in zip(sentences, expected, actual) if e != a]
+    if mismatches:
+        raise AssertionError('PhraseMatcher differs from the regex path for %d sentences, e.g. %r' % (len(mismatches), mismatches[0]))
+
+    report('extract_keywords regex (%d keywords)' % len(terms), regex_elapsed, len(sentences))
+    report('extract_keywords trie (%d keywords)' % len(terms), matcher_elapsed, len(sentences))
+
+def build_lexicon(rng, vocabulary, count):
+    lines = []
+    for word in rng.sample(vocabulary, count):
+        if rng.random() < 0.15:
+            word = ' '.join([word] + rng.sample(vocabulary, rng.randint(1, 2)))
+        lines.append(json.dumps({'word': word, 'pos': round(rng.random(), 3), 'neg': round(rng.random(), 3)}))
+    return lines
+
+def reference_score(scorer, max_len, sentence):
+    # the joined-substring lookup the trie replaced
+    tokenize = job.get_tokenizer()
+    pos_score, neg_score = 0., 0.
+    tokens = tokenize(sentence.lower())
+    term_count = 0
+    i = 0
+    while i < len(tokens):
+        matched = False
+        j = min(max_len, len(tokens) - i)
+        while j > 0 and (i + j) <= len(tokens):
+            sub_word = ' '.join(tokens[i : i + j])
+            if sub_word in scorer.lookup:
+                pos_score += scorer.lookup[sub_word][0]
+                neg_score += scorer.lookup[sub_word][1]
+                term_count += 1
+                matched = True
+                i += j
+                break
+            j -= 1
+        if not matched:
+            i += 1
+    if pos_score == neg_score:
+        return 0.5
+    elif pos_score > neg_score:
+        return 0.5 + pos_score / term_count / 2
+    else:
+        return 0.5 - neg_score / term_count / 2
+
+def bench_sentiment_score(args, rng):
+    vocabulary = build_vocabulary(rng, args.vocabulary)
+    scorer = job.SentimentScorer(build_lexicon(rng, vocabulary, min(args.lexicon, len(vocabulary))))
+    sentences = build_sentences(rng, vocabulary, dict((term, term) for term in scorer.lookup), args.sentences)
+
+    tokenize = job.get_tokenizer()
+    max_len = max(len(tokenize(term)) for term in scorer.lookup)
+    expected, reference_elapsed = timed(lambda sentence: reference_score(scorer, max_len, sentence), sentences)
+    actual, trie_elapsed = timed(scorer.score, sentences)
+    if expected != actual:
+        raise AssertionError('SentimentScorer.score differs from the substring lookup')
+
+    report('SentimentScorer substring lookup', reference_elapsed, len(sentences))
+    report('SentimentScorer trie (%d terms)' % len(scorer.lookup), trie_elapsed, len(sentences))
+
+def build_tweet(rng, vocabulary, index):
+    user = random_word(rng)
+    return {
+        'MessageId': '%d' % (800000000000000000 + index),
+        'Source': 'twitter',
+        'Created': '2016-05-%02dT%02d:%02d:00+00:00' % (rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59)),
+        'Sentence': u' '.join(rng.choice(vocabulary) for _ in range(rng.randint(5, 25))),
+        'Locations': [{'type': 'Point', 'coordinates': [rng.uniform(-180, 180), rng.uniform(-85, 85)]}],
+        'Language': 'en',
+        'User': {'id': rng.randint(1, 10 ** 9), 'screen_name': user, 'followers_count': rng.randint(0, 10 ** 6),
+                 'description': u' '.join(rng.choice(vocabulary) for _ in range(12)),
+                 'profile_image_url': 'https://pbs.twimg.com/profile_images/%d/%s.jpg' % (rng.randint(1, 10 ** 9), user)},
+        'Entities': {'hashtags': [{'text': rng.choice(vocabulary), 'indices': [0, 8]} for _ in range(rng.randint(0, 4))],
+                     'urls': [{'url': 'https://t.co/%s' % random_word(rng), 'expanded_url': 'https://example.com/%s' % random_word(rng)}]},
+        'RetweetCount': rng.randint(0, 1000),
+        'FavoriteCount': rng.randint(0, 1000),
+    }
+
+def build_facebook_post(rng, vocabulary, index):
+    return {
+        'MessageId': '%d_%d' % (rng.randint(10 ** 14, 10 ** 15), index),
+        'Source': 'facebook-messages',
+        'Created': '2016-05-%02dT%02d:%02d:00+0000' % (rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59)),
+        'Sentence': u' '.join(rng.choice(vocabulary) for _ in range(rng.randint(20, 120))),
+        'Locations': [{'type': 'Point', 'coordinates': [rng.uniform(-180, 180), rng.uniform(-85, 85)]}],
+        'From': {'name': random_word(rng).title(), 'id': '%d' % rng.randint(10 ** 9, 10 ** 10)},
+        'Comments': [{'message': u' '.join(rng.choice(vocabulary) for _ in range(10)), 'id': '%d' % i} for i in range(rng.randint(0, 5))],
+        'Likes': rng.randint(0, 5000),
+    }
+
+def bench_json(args, rng):
+    vocabulary = build_vocabulary(rng, args.vocabulary)
+    messages = [build_tweet(rng, vocabulary, i) if rng.random() < 0.7 else build_facebook_post(rng, vocabulary, i) for i in range(args.sentences)]
+    lines = [json.dumps(message) for message in messages]
+    fields = job.parse_message_fields('Language')
+
+    expected, stdlib_elapsed = timed(json.loads, lines)
+    actual, fast_elapsed = timed(job.fast_loads, lines)
+    if expected != actual:
+        raise AssertionError('fast_loads differs from json.loads')
+    projected, projected_elapsed = timed(lambda line: job.project_message(job.fast_loads(line), fields), lines)
+
+    report('message decode json.loads', stdlib_elapsed, len(lines))
+    report('message decode fast_loads', fast_elapsed, len(lines))
+    report('message decode fast_loads + projection', projected_elapsed, len(lines))
+
+    dumped, stdlib_elapsed = timed(json.dumps, projected)
+    dumped, fast_elapsed = timed(job.normalize_message, projected)
+    if [json.loads(line) for line in dumped] != projected:
+        raise AssertionError('normalize_message does not round trip')
+
+    report('message encode json.dumps', stdlib_elapsed, len(projected))
+    report('message encode normalize_message', fast_elapsed, len(projected))
+
+def bench_tile(args, rng):
+    count = args.sentences * 10
+    latitudes = [rng.uniform(-85, 85) for _ in range(count)]
+    longitudes = [rng.uniform(-180, 180) for _ in range(count)]
+    points = zip(latitudes, longitudes)
+
+    ids, elapsed = timed(lambda point: job.Tile.tile_id_from_lat_long(point[0], point[1], 16), points)
+    report('Tile.tile_id_from_lat_long', elapsed, count)
+    keys, elapsed = timed(lambda point: job.Tile.tile_key_from_lat_long(point[0], point[1], 16), points)
+    report('Tile.tile_key_from_lat_long', elapsed, count)
+
+    start = time.time()
+    batch_keys = job.Tile.tile_keys_from_lat_long(latitudes, longitudes, 16)
+    report('Tile.tile_keys_from_lat_long (batch)', time.time() - start, count)
+    if [int(key) for key in batch_keys] != keys:
+        raise AssertionError('tile_keys_from_lat_long differs from tile_key_from_lat_long')
+
+    _, elapsed = timed(lambda tile_id: job.Tile.tile_ids_for_all_zoom_levels(tile_id), ids[:args.sentences])
+    report('Tile.tile_ids_for_all_zoom_levels', elapsed, args.sentences)
+    _, elapsed = timed(lambda key: job.Tile.ancestor_tile_key(key, 8), keys)
+    report('Tile.ancestor_tile_key', elapsed, count)
+    _, elapsed = timed(job.Tile.tile_id_from_tile_key, keys)
+    report('Tile.tile_id_from_tile_key', elapsed, count)
+
+def bench_merge_sentiment(args, rng):
+    count = args.sentences * 50
+    values = [job.SentimentAccumulator.of(rng.random()) for _ in range(count)]
+    total = job.SentimentAccumulator()
+    start = time.time()
+    for value in values:
+        job.merge_sentiment(total, value)
+    report('merge_sentiment', time.time() - start, count)
+    if total.count != count:
+        raise AssertionError('merge_sentiment lost counts')
+
+def bench_keyword_counts(args, rng):
+    # the timeseries combiner: add messages to the counts of their hour,
+    # merge the counts of partitions and pickle them for the shuffle
+    keywords = [u'kw%d' % i for i in range(args.keywords)]
+    messages = [{ 'Keywords': rng.sample(keywords, rng.randint(1, 4)), 'Sentiment': rng.random() } for _ in range(args.sentences * 10)]
+    start = time.time()
+    hours = [job.KeywordCounts() for _ in range(24)]
+    for index, message in enumerate(messages):
+        hours[index % 24].add(message)
+    report('keyword_counts_add', time.time() - start, len(messages))
+    start = time.time()
+    total = job.KeywordCounts()
+    for hour in hours:
+        total.merge(hour)
+    report('keyword_counts_merge', time.time() - start, len(hours))
+    start = time.time()
+    for hour in hours:
+        cPickle.loads(cPickle.dumps(hour, 2))
+    report('keyword_counts_pickle', time.time() - start, len(hours))
+    if total.messages != len(messages):
+        raise AssertionError('KeywordCounts lost messages')
+
+BENCHMARKS = [
+    ('extract_keywords', bench_extract_keywords),
+    ('sentiment_score', bench_sentiment_score),
+    ('json', bench_json),
+    ('tile', bench_tile),
+    ('merge_sentiment', bench_merge_sentiment),
+    ('keyword_counts', bench_keyword_counts),
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keywords', type=int, default=2000)
+    parser.add_argument('--sentences', type=int, default=2000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--lexicon', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', default=None, help='comma separated list of benchmarks to run')
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    parser.add_argument('--compare', default=None, help='json file of earlier results to compare with')
+    args = parser.parse_args()
+
+    for name, benchmark in BENCHMARKS:
+        if args.only and name not in args.only.split(','):
+            continue
+        benchmark(args, random.Random(args.seed))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        print
+        for name in sorted(set(baseline) & set(RESULTS)):
+            print '%-40s %+9.1f%% us/op' % (name, (RESULTS[name]['us_per_op'] / baseline[name]['us_per_op'] - 1) * 100)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({ 'config': vars(args), 'numpy': job.np != None, 'results': RESULTS }, output, indent=2, sort_keys=True)
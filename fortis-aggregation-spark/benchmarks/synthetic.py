@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic fixtures for the byTile job: message streams in the input format
+of the job, and the keyword, filter and sentiment files the file data
+source reads in place of table and blob storage.
+"""
+
+import json
+import os
+import random
+import string
+
+ARABIC_LETTERS = [unichr(c) for c in range(0x0627, 0x064b)]
+
+def random_word(rng, min_len=3, max_len=9, letters=string.ascii_lowercase):
+    return u''.join(rng.choice(letters) for _ in range(rng.randint(min_len, max_len)))
+
+def build_vocabulary(rng, size, letters=string.ascii_lowercase):
+    return list(set(random_word(rng, letters=letters) for _ in range(size)))
+
+def parse_mix(spec):
+    # 'en=0.7,ar=0.3' => {'en': 0.7, 'ar': 0.3}
+    mix = {}
+    for part in spec.split(','):
+        language, weight = part.split('=')
+        mix[language.strip()] = float(weight)
+    return mix
+
+def choose(rng, weights):
+    roll = rng.random() * sum(weights.values())
+    for value, weight in sorted(weights.items()):
+        roll -= weight
+        if roll < 0:
+            return value
+    return value
+
+class MessageGenerator:
+    '''Messages with a configurable language mix, keyword density, number of
+    locations per message and share of duplicated sentences (retweets). The
+    locations are spread around `center` so that tiles repeat like they do
+    for a single country.
+    '''
+    def __init__(self, seed=42, vocabulary_size=20000, keyword_count=500, languages='en=0.8,ar=0.2',
+                 keywords_per_message=1.5, max_locations=2, duplicate_ratio=0.2, sentence_length=18,
+                 center=(7.0, 80.0), spread=2.0, filter_ratio=0.02):
+        self.rng = random.Random(seed)
+        self.languages = parse_mix(languages)
+        self.keywords_per_message = keywords_per_message
+        self.max_locations = max_locations
+        self.duplicate_ratio = duplicate_ratio
+        self.sentence_length = sentence_length
+        self.center = center
+        self.spread = spread
+        self.filter_ratio = filter_ratio
+        self.vocabulary = {
+            'en': build_vocabulary(self.rng, vocabulary_size),
+            'ar': build_vocabulary(self.rng, vocabulary_size, ARABIC_LETTERS),
+        }
+        # canonical english keyword => (english term, arabic term)
+        self.keywords = {}
+        while len(self.keywords) < keyword_count:
+            english = self.rng.choice(self.vocabulary['en'])
+            if self.rng.random() < 0.2:
+                english = u'%s %s' % (english, self.rng.choice(self.vocabulary['en']))
+            self.keywords[english.lower()] = (english, self.rng.choice(self.vocabulary['ar']))
+        self.filters = [[self.rng.choice(self.vocabulary['en']), self.rng.choice(self.vocabulary['en'])] for _ in range(20)]
+        self.sentences = []
+
+    def sentence(self, language):
+        words = [self.rng.choice(self.vocabulary[language]) for _ in range(self.sentence_length)]
+        terms = self.rng.sample(sorted(self.keywords.values()), min(len(self.keywords), int(self.rng.expovariate(1.0 / self.keywords_per_message) + 0.5))) if self.keywords_per_message else []
+        for english, arabic in terms:
+            words.insert(self.rng.randint(0, len(words)), english if language == 'en' else arabic)
+        if self.rng.random() < self.filter_ratio:
+            words.extend(self.rng.choice(self.filters))
+        return u' '.join(words)
+
+    def message(self, day, index):
+        if self.sentences and self.rng.random() < self.duplicate_ratio:
+            sentence = self.rng.choice(self.sentences)
+        else:
+            sentence = self.sentence(choose(self.rng, self.languages))
+            if len(self.sentences) < 10000:
+                self.sentences.append(sentence)
+        locations = []
+        for _ in range(self.rng.randint(1, self.max_locations)):
+            locations.append({'type': 'Point', 'coordinates': [
+                self.center[1] + self.rng.uniform(-self.spread, self.spread),
+                self.center[0] + self.rng.uniform(-self.spread, self.spread)]})
+        return {
+            'MessageId': '%s-%d' % (day, index),
+            'Source': self.rng.choice(['twitter', 'twitter', 'facebook-messages']),
+            'Created': '%sT%02d:%02d:%02d.000Z' % (day, self.rng.randint(0, 23), self.rng.randint(0, 59), self.rng.randint(0, 59)),
+            'Sentence': sentence,
+            'Locations': locations,
+        }
+
+    def write_day(self, folder, day, count, files=4):
+        # json lines part files like the ones StreamAnalytics writes
+        day_folder = os.path.join(folder, day)
+        os.makedirs(day_folder)
+        outputs = [open(os.path.join(day_folder, 'part-%05d.json' % i), 'w') for i in range(files)]
+        try:
+            for index in range(count):
+                outputs[index % files].write(json.dumps(self.message(day, index)) + '\n')
+        finally:
+            for output in outputs:
+                output.close()
+
+    def write_tables(self, keyword_path, filter_path):
+        with open(keyword_path, 'w') as output:
+            for english, arabic in sorted(self.keywords.values()):
+                output.write(json.dumps({'en_term': english, 'ar_term': arabic}) + '\n')
+        with open(filter_path, 'w') as output:
+            for terms in self.filters:
+                output.write(json.dumps({'filteredTerms': json.dumps(terms)}) + '\n')
+
+    def write_sentiment_model(self, path, count=5000):
+        with open(path, 'w') as output:
+            for word in self.rng.sample(self.vocabulary['en'], min(count, len(self.vocabulary['en']))):
+                entry = {'word': word, 'pos': round(self.rng.random(), 3), 'neg': round(self.rng.random(), 3)}
+                if self.rng.random() < 0.5:
+                    entry['word_ar'] = self.rng.choice(self.vocabulary['ar'])
+                output.write(json.dumps(entry) + '\n')
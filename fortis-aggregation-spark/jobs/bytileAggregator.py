@@ -6,24 +6,60 @@ Created on Wed May 11 21:45:55 2016
 """
 
 from dateutil.parser import parse
-from pyspark import SparkConf, SparkContext
-import copy
+from pyspark import AccumulatorParam, SparkConf, SparkContext
+from pyspark.rdd import portable_hash
+import array
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
 import json
+import logging
+import mmap
 import os
 import random
 import re
 import shutil
+import struct
+import sys
 import time
+import zlib
 from datetime import datetime, timedelta
 
 #from tile import Tile
 import math
 
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 class Tile:
 
     MAX_ZOOM = 16
     MIN_ZOOM = 0
 
+    # tile keys pack zoom, row and column into one 64-bit integer (zoom in
+    # the top bits, then 29 bits each for row and column) so that parents
+    # and children can be derived with bit shifts instead of trigonometry
+    KEY_ZOOM_SHIFT = 58
+    KEY_ROW_SHIFT = 29
+    KEY_COORDINATE_MASK = (1 << 29) - 1
+    INVALID_TILE_KEY = -1
+
     @classmethod
     def tile_id_from_lat_long(cls, latitude, longitude, zoom):
         row = int(Tile.row_from_latitude(latitude, zoom))
@@ -76,8 +112,102 @@ class Tile:
     def tile_id_from_row_column(cls, row, column, zoom):
         return '%s_%s_%s' % (zoom, row, column)
 
+    @classmethod
+    def tile_key_from_row_column(cls, row, column, zoom):
+        return (zoom << Tile.KEY_ZOOM_SHIFT) | (row << Tile.KEY_ROW_SHIFT) | column
+
+    @classmethod
+    def row_column_zoom_from_tile_key(cls, key):
+        return ((key >> Tile.KEY_ROW_SHIFT) & Tile.KEY_COORDINATE_MASK,
+                key & Tile.KEY_COORDINATE_MASK,
+                key >> Tile.KEY_ZOOM_SHIFT)
+
+    @classmethod
+    def tile_id_from_tile_key(cls, key):
+        row, column, zoom = Tile.row_column_zoom_from_tile_key(int(key))
+        return Tile.tile_id_from_row_column(row, column, zoom)
+
+    @classmethod
+    def tile_key_from_tile_id(cls, tile_id):
+        tile = Tile.decode_tile_id(tile_id)
+        if tile is None:
+            return
+        return Tile.tile_key_from_row_column(tile['row'], tile['column'], tile['zoom'])
+
+    @classmethod
+    def tile_key_from_lat_long(cls, latitude, longitude, zoom):
+        row = int(Tile.row_from_latitude(latitude, zoom))
+        column = int(Tile.column_from_longitude(longitude, zoom))
+        if not (0 <= row < 2 ** zoom and 0 <= column < 2 ** zoom):
+            raise ValueError('(%s, %s) is outside of the tile grid' % (latitude, longitude))
+        return Tile.tile_key_from_row_column(row, column, zoom)
+
+    @classmethod
+    def ancestor_tile_key(cls, key, zoom):
+        row, column, key_zoom = Tile.row_column_zoom_from_tile_key(key)
+        levels = key_zoom - zoom
+        return Tile.tile_key_from_row_column(row >> levels, column >> levels, zoom)
+
+    @classmethod
+    def parent_tile_key(cls, key):
+        return Tile.ancestor_tile_key(key, (key >> Tile.KEY_ZOOM_SHIFT) - 1)
+
+    @classmethod
+    def children_tile_keys(cls, key):
+        row, column, zoom = Tile.row_column_zoom_from_tile_key(key)
+        row, column = row << 1, column << 1
+        # same order as `children`: north east, north west, south east, south west
+        return [
+            Tile.tile_key_from_row_column(row, column + 1, zoom + 1),
+            Tile.tile_key_from_row_column(row, column, zoom + 1),
+            Tile.tile_key_from_row_column(row + 1, column + 1, zoom + 1),
+            Tile.tile_key_from_row_column(row + 1, column, zoom + 1)
+        ]
+
+    @classmethod
+    def tile_keys_from_lat_long(cls, latitudes, longitudes, zoom):
+        # batch version of `tile_key_from_lat_long`, points outside of the
+        # tile grid get INVALID_TILE_KEY instead of raising
+        if np is None:
+            keys = []
+            for latitude, longitude in zip(latitudes, longitudes):
+                try:
+                    keys.append(Tile.tile_key_from_lat_long(latitude, longitude, zoom))
+                except ValueError:
+                    keys.append(Tile.INVALID_TILE_KEY)
+            return keys
+
+        size = 2 ** zoom
+        radians = np.asarray(latitudes, dtype=np.float64) * math.pi / 180
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            rows = np.floor((1 - np.log(np.tan(radians) + 1 / np.cos(radians)) / math.pi) / 2 * size)
+            columns = np.floor((longitudes + 180.0) / 360.0 * size)
+            valid = (rows >= 0) & (rows < size) & (columns >= 0) & (columns < size)
+        rows = np.where(valid, rows, 0).astype(np.int64)
+        columns = np.where(valid, columns, 0).astype(np.int64)
+        return np.where(valid, Tile.tile_key_from_row_column(rows, columns, zoom), Tile.INVALID_TILE_KEY)
+
+    @classmethod
+    def ancestor_tile_keys(cls, keys, zoom):
+        # batch version of `ancestor_tile_key`, invalid keys stay invalid;
+        # the keys come back as a list of plain ints, which is what the
+        # shuffle, the combiner and the state expect rather than numpy scalars
+        if np is None:
+            return [Tile.ancestor_tile_key(key, zoom) if key != Tile.INVALID_TILE_KEY else key for key in keys]
+
+        keys = np.asarray(keys, dtype=np.int64)
+        valid = keys != Tile.INVALID_TILE_KEY
+        rows, columns, key_zooms = Tile.row_column_zoom_from_tile_key(keys)
+        levels = np.where(valid, key_zooms - zoom, 0)
+        ancestors = Tile.tile_key_from_row_column(rows >> levels, columns >> levels, zoom)
+        return np.where(valid, ancestors, Tile.INVALID_TILE_KEY).tolist()
+
+    def tile_key(self):
+        return Tile.tile_key_from_row_column(self.row, self.column, self.zoom)
+
     def parent_id(self):
-        return Tile.tile_id_from_lat_long(self.center_latitude, self.center_longitude, self.zoom-1)
+        return Tile.tile_id_from_tile_key(Tile.parent_tile_key(self.tile_key()))
 
     def parent(self):
         return Tile.tile_from_tile_id(self.parent_id())
@@ -98,23 +228,19 @@ class Tile:
     @classmethod
     def tile_ids_for_all_zoom_levels(cls, tileId):
         tile = Tile.tile_from_tile_id(tileId)
+        tileKey = tile.tile_key()
         tileIds = []
         for zoom in range(Tile.MAX_ZOOM, Tile.MIN_ZOOM, -1):
-            tileId = Tile.tile_id_from_lat_long(tile.center_latitude, tile.center_longitude, zoom)
+            if zoom <= tile.zoom:
+                tileId = Tile.tile_id_from_tile_key(Tile.ancestor_tile_key(tileKey, zoom))
+            else:
+                # levels finer than the tile itself still need the tile center
+                tileId = Tile.tile_id_from_lat_long(tile.center_latitude, tile.center_longitude, zoom)
             tileIds.append(tileId)
         return tileIds
 
     def children(self):
-        midNorthLatitude = (self.center_latitude + self.latitude_north) / 2
-        midSouthLatitude = (self.center_latitude + self.latitude_south) / 2
-        midEastLongitude = (self.center_longitude + self.longitude_east) / 2
-        midWestLongitude = (self.center_longitude + self.longitude_west) / 2
-        return [
-            Tile.tile_id_from_lat_long(midNorthLatitude, midEastLongitude, self.zoom + 1),
-            Tile.tile_id_from_lat_long(midNorthLatitude, midWestLongitude, self.zoom + 1),
-            Tile.tile_id_from_lat_long(midSouthLatitude, midEastLongitude, self.zoom + 1),
-            Tile.tile_id_from_lat_long(midSouthLatitude, midWestLongitude, self.zoom + 1)
-        ]
+        return [Tile.tile_id_from_tile_key(key) for key in Tile.children_tile_keys(self.tile_key())]
 
 import io
 
@@ -128,9 +254,45 @@ def getenv(key, default=None, converter=lambda x: x):
         raise Exception('Expected %s in os.environ' % key)
     return converter(os.environ[key]) if key in os.environ else default
     
+def fast_loads(line):
+    # decode with the fastest parser available; anything it rejects (e.g.
+    # integers beyond 64 bits) goes through the standard library
+    try:
+        if orjson != None:
+            return orjson.loads(line)
+        elif ujson != None:
+            return ujson.loads(line)
+    except (ValueError, OverflowError):
+        pass
+    return json.loads(line)
+
+def fast_dumps(obj):
+    # encode with the fastest encoder available; anything it rejects (e.g.
+    # integers beyond 64 bits, which orjson raises a TypeError for) goes
+    # through the standard library
+    try:
+        if orjson != None:
+            return orjson.dumps(obj).decode('utf-8')
+        elif ujson != None:
+            return ujson.dumps(obj, escape_forward_slashes=False)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return json.dumps(obj)
+
+def project_message(message, fields):
+    # drop the parts of the payload the pipeline has no use for
+    return dict((key, message[key]) for key in fields if key in message)
+
+def parse_message_fields(spec):
+    # comma separated message fields to keep besides the required ones,
+    # None to keep every field
+    if not spec.strip():
+        return None
+    return sorted(set(REQUIRED_KEYS) | set(field.strip() for field in spec.split(',') if field.strip()))
+
 def safe_load(line):
     try:
-        return ('valid', json.loads(line))
+        return ('valid', fast_loads(line))
     except ValueError as err:
         return ('parse_error', u'Failed to load %s: %s' % (line, str(err)))
 
@@ -139,25 +301,63 @@ def has_keywords(x):
     total_sections = slen(x, 'Keywords')
     return total_sections > 0
 
-def filter_to_valid(rdd, stats, stats_suffix, check_keys=True, required_keys=['Created', 'Locations', 'MessageId', 'Sentence', 'Source']):
+REQUIRED_KEYS = ['Created', 'Locations', 'MessageId', 'Sentence', 'Source']
+
+def validate_message(line, stats_suffix, check_keys=True, required_keys=REQUIRED_KEYS, fields=None):
+    # returns the stats key of the outcome and the message, projected on
+    # `fields` if given
+    k = safe_load(line)
+    if k[0] != 'valid':
+        return k
+    s = k[1]
+    if check_keys:
+        for key in required_keys:
+            if not key in s:
+                return ('missing_%s_%s' % (key, stats_suffix), s)
+    if fields != None:
+        s = project_message(s, fields)
+    return ('valid_%s' % stats_suffix, s)
+
+def filter_to_valid(rdd, stats, stats_suffix, check_keys=True, required_keys=REQUIRED_KEYS):
     valid_key = 'valid_%s' % stats_suffix
+    # count the outcomes while the messages are parsed rather than in a separate job
+    validation_counts = stats.counts('validation_%s' % stats_suffix)
+
+    def validator(iterator):
+        counts = {}
+        for line in iterator:
+            key, message = validate_message(line, stats_suffix, check_keys, required_keys)
+            counts[key] = counts.get(key, 0) + 1
+            if key == valid_key:
+                yield message
+        validation_counts.add(counts)
+
+    return rdd.mapPartitions(validator)
     
-    def validator(k):
-        if k[0] != 'valid':
-            return k
-        s = k[1]
-        if check_keys:
-            for key in required_keys:
-                if not key in s:
-                    return ('missing_%s_%s' % (key, stats_suffix), s)
-        return (valid_key, s)
-        
-    validated = rdd.map(safe_load).map(validator)
-    print 'before countByKey'
-    stats.add_stats(validated.countByKey())
-    print 'after countByKey'
-    return validated.filter(lambda x: x[0] == valid_key).map(lambda x: x[1])
-    
+CREATED_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?(?:Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+def parse_created(created):
+    # the ISO-8601 timestamps of the messages are read with a regular
+    # expression and only other formats go through dateutil; the labels
+    # only use the wall clock fields, so the UTC offset is not applied
+    match = CREATED_PATTERN.match(created)
+    if match == None:
+        return parse(created)
+    year, month, day, hour, minute, second = match.groups()
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0))
+
+TIMESPAN_TYPES = ['alltime', 'year', 'month', 'week', 'day', 'hour']
+
+def build_timespan_labels(timestampDate, labelsByHour=None):
+    # all the labels of the hour of `timestampDate`, memoized in `labelsByHour`
+    hour = (timestampDate.year, timestampDate.month, timestampDate.day, timestampDate.hour)
+    if labelsByHour != None and hour in labelsByHour:
+        return labelsByHour[hour]
+    labels = dict((timespanType, build_timespan_label(timespanType, timestampDate)) for timespanType in TIMESPAN_TYPES)
+    if labelsByHour != None:
+        labelsByHour[hour] = labels
+    return labels
+
 def build_timespan_label(timespanType, timestampDate):
     if timespanType == 'alltime':
         return 'alltime'
@@ -172,14 +372,159 @@ def build_timespan_label(timespanType, timestampDate):
     elif timespanType == 'hour':
         return 'hour-%d-%02d-%02d-%02d:00' % (timestampDate.year, timestampDate.month, timestampDate.day, timestampDate.hour)
     
+def iso_week_start(isoYear, week):
+    # the monday of an ISO week; January 4th is always in week 1
+    jan4 = datetime(isoYear, 1, 4)
+    return jan4 - timedelta(days=jan4.isoweekday() - 1) + timedelta(weeks=week - 1)
+
+def timespan_label_end(timespanLabel):
+    # the end of the period covered by a label from `build_timespan_label`
+    # or by a group of hours or days from `state_timespan_group`, None for
+    # labels that never end
+    parts = timespanLabel.split('-')
+    timespanType = parts[0]
+    if timespanType == 'hour' and len(parts) == 4:
+        return datetime(int(parts[1]), int(parts[2]), int(parts[3])) + timedelta(days=1)
+    elif timespanType == 'hour':
+        return datetime(int(parts[1]), int(parts[2]), int(parts[3]), int(parts[4].split(':')[0])) + timedelta(hours=1)
+    elif timespanType == 'day' and len(parts) == 3:
+        year, month = int(parts[1]), int(parts[2])
+        return datetime(year + month // 12, month % 12 + 1, 1)
+    elif timespanType == 'day':
+        return datetime(int(parts[1]), int(parts[2]), int(parts[3])) + timedelta(days=1)
+    elif timespanType == 'week':
+        year, week = int(parts[1]), int(parts[2])
+        # labels combine the calendar year with the ISO week, so week 1 can
+        # also hold the last days of December and weeks 52 and 53 the first
+        # days of January; the label ends with the last of its days
+        yearStart, yearEnd = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+        end = None
+        for isoYear in (year - 1, year, year + 1):
+            weekStart = iso_week_start(isoYear, week)
+            if weekStart.isocalendar()[:2] != (isoYear, week):
+                continue
+            if max(weekStart, yearStart) < min(weekStart + timedelta(weeks=1), yearEnd):
+                end = min(weekStart + timedelta(weeks=1), yearEnd)
+        return end
+    elif timespanType == 'month':
+        year, month = int(parts[1]), int(parts[2])
+        return datetime(year + month // 12, month % 12 + 1, 1)
+    elif timespanType == 'year':
+        return datetime(int(parts[1]) + 1, 1, 1)
+    return None
+
+DEFAULT_STATE_RETENTION = ''
+RETENTION_UNITS = { 'h': timedelta(hours=1), 'd': timedelta(days=1), 'w': timedelta(weeks=1) }
+
+'''Decides which timespan buckets are too old to keep in the aggregate
+state. The retention is configured per timespan type, for example
+`hour=48h,day=90d,week=26w`; types without a retention are kept forever.
+'''
+class RetentionPolicy:
+    def __init__(self, retention, now):
+        self.retention = retention
+        self.now = now
+
+    @classmethod
+    def from_spec(cls, spec, now):
+        retention = {}
+        for entry in spec.split(','):
+            if not entry.strip():
+                continue
+            timespanType, duration = entry.strip().split('=')
+            if timespanType not in TIMESPAN_TYPES or timespanType == 'alltime':
+                raise ValueError('No retention for timespans of type %s' % timespanType)
+            retention[timespanType] = int(duration[:-1]) * RETENTION_UNITS[duration[-1]]
+        return RetentionPolicy(retention, now)
+
+    def is_expired(self, timespanLabel):
+        timespanType = timespanLabel.split('-')[0]
+        if timespanType not in self.retention:
+            return False
+        return timespan_label_end(timespanLabel) + self.retention[timespanType] < self.now
+
+    def keeps(self, kv):
+        return not self.is_expired(kv[0][4])
+
+'''Histogram of values observed on the executors, e.g. the number of
+keywords per message. Tasks observe values into a local copy and add it
+to the backing accumulator once, when they are done.
+'''
+class Histogram:
+    def __init__(self, bounds, accumulator=None):
+        self.bounds = bounds
+        self.accumulator = accumulator
+        self.counts = {}
+
+    def local(self):
+        return Histogram(self.bounds, self.accumulator)
+
+    def observe(self, value):
+        # bucket i counts the values up to bounds[i], the last one the rest
+        bucket = bisect.bisect_left(self.bounds, value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.counts['sum'] = self.counts.get('sum', 0) + value
+
+    def commit(self):
+        if self.counts:
+            self.accumulator.add(self.counts)
+            self.counts = {}
+
+    @classmethod
+    def summary(cls, bounds, counts):
+        buckets = [counts.get(i, 0) for i in range(len(bounds) + 1)]
+        return { 'bounds': bounds, 'counts': buckets, 'count': sum(buckets), 'sum': counts.get('sum', 0) }
+
+class Span:
+    # wall clock time of a step of the driver, usable as a context manager
+    # or as a decorator; the time of repeated spans adds up
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        spans = self.stats.spans
+        spans[self.name] = spans.get(self.name, 0.0) + time.time() - self.start
+        return False
+
+    def __call__(self, fn):
+        def timed(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+        return timed
+
+class KeyCountsParam(AccumulatorParam):
+    # adds up dicts of counts per key, e.g. of a `Stats.counts` accumulator
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, counts, other):
+        for key, count in other.iteritems():
+            counts[key] = counts.get(key, 0) + count
+        return counts
+
+PROMETHEUS_PREFIX = 'fortis_bytile_'
+
 '''Simple class for managing, and then writing, job statistics
 Use within a `with` block, and `add_stat` or `update_stat` for any additional stats you need.
+Use `counter` for counts collected on the executors.
 '''
 class Stats:
-    def __init__(self, data_source, container):
+    def __init__(self, data_source, container, spark_context=None, prometheus_path=None):
         self.data_source = data_source
         self.container = container
+        self.spark_context = spark_context
+        self.prometheus_path = prometheus_path
         self.payload = {}
+        self.counters = {}
+        self.key_counts = {}
+        self.histograms = {}
+        self.spans = {}
+        self.derived = {}
         
     def __enter__(self):
         self.start()
@@ -215,14 +560,54 @@ class Stats:
     def __getitem__(self, key):
         return self.payload[key]
 
+    def counter(self, key):
+        # accumulator whose value is added to the stats when they are written
+        if key not in self.counters:
+            self.counters[key] = self.spark_context.accumulator(0)
+        return self.counters[key]
+
+    def counts(self, name):
+        # accumulator of counts per key, all of which are added to the stats
+        if name not in self.key_counts:
+            self.key_counts[name] = self.spark_context.accumulator({}, KeyCountsParam())
+        return self.key_counts[name]
+
+    def histogram(self, name, bounds):
+        # Histogram whose summary is added to the stats under `histograms`
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds, self.spark_context.accumulator({}, KeyCountsParam()))
+        return self.histograms[name]
+
+    def span(self, name):
+        # time a step of the job: `with stats.span('segment'):` or `@stats.span('segment')`
+        return Span(self, name)
+
+    def derive(self, key, fn):
+        # stat computed from the final payload, once the counters are in
+        self.derived[key] = fn
+
     def start(self):
         self.payload = {}
+        self.spans = {}
         self.payload['Start'] = unix_time_millis(datetime.utcnow())
     
     def exception(self, exception_type, exception_value, traceback):
         self.payload['Exception'] = 'Exception %s: %s: %s' % (str(exception_type), str(exception_value), str(traceback))
         
     def end(self):
+        for key, counter in self.counters.items():
+            self.payload[key] = counter.value
+        for counts in self.key_counts.values():
+            self.add_stats(counts.value)
+        if self.histograms:
+            self.payload['histograms'] = dict((name, Histogram.summary(histogram.bounds, histogram.accumulator.value)) for name, histogram in self.histograms.items())
+        if self.spans:
+            self.payload['spans'] = dict(self.spans)
+        for key, fn in self.derived.items():
+            try:
+                self.payload[key] = fn(self.payload)
+            except (KeyError, ZeroDivisionError):
+                pass
         self.payload['End'] = unix_time_millis(datetime.utcnow())
         self.write_stats()
     
@@ -230,8 +615,155 @@ class Stats:
         try:
             self.data_source.saveAsJson(self.payload, self.container, 'stats.json')
         except Exception as e:
-            print 'Failed to save stats %s: %s' % (json.dumps(self.payload), str(e))
+            logger.error('Failed to save stats %s: %s', json.dumps(self.payload), str(e))
+        if self.prometheus_path:
+            try:
+                self.write_prometheus(self.prometheus_path)
+            except Exception as e:
+                logger.error('Failed to save stats to %s: %s', self.prometheus_path, str(e))
+
+    def prometheus_lines(self):
+        # the numeric stats in the Prometheus text exposition format
+        name = lambda key: PROMETHEUS_PREFIX + re.sub('[^a-zA-Z0-9_]', '_', key)
+        lines = []
+        for key, value in sorted(self.payload.items()):
+            if type(value) in (int, long, float) and type(value) != bool:
+                lines.append('# TYPE %s gauge' % name(key))
+                lines.append('%s %r' % (name(key), value))
+        if self.spans:
+            lines.append('# TYPE %s gauge' % name('span_seconds'))
+            for span, seconds in sorted(self.spans.items()):
+                lines.append('%s{span="%s"} %r' % (name('span_seconds'), span, seconds))
+        for key, summary in sorted(self.payload.get('histograms', {}).items()):
+            lines.append('# TYPE %s histogram' % name(key))
+            cumulative = 0
+            for bound, count in zip(summary['bounds'] + ['+Inf'], summary['counts']):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (name(key), bound, cumulative))
+            lines.append('%s_sum %r' % (name(key), summary['sum']))
+            lines.append('%s_count %d' % (name(key), summary['count']))
+        return lines
+
+    def write_prometheus(self, path):
+        # for the textfile collector of the node exporter, which must never
+        # see a partial file
+        with open(path + '.tmp', 'w') as file:
+            file.write('\n'.join(self.prometheus_lines()) + '\n')
+        os.rename(path + '.tmp', path)
         
+'''Compact binary encoding for aggregate state records such as
+`(('keyword', source, kw1, kw2, timespan, tileKey), [count, sentiment])`.
+Records are written in zlib compressed, columnar blocks of records with
+the same shape: the NUL separated table of distinct strings used by the
+keys, then the string key parts as indices into that table, then the
+integer key parts (e.g. packed tile keys) as 64-bit integers, then all
+values as doubles. Loading a block is a couple of array conversions,
+with no parsing and no `eval`.
+'''
+class StateCodec:
+    MAGIC = 'FTS3'
+    BLOCK_SIZE = 4096
+    # string table length, record count, key length, value length, and the
+    # bit mask of the integer key parts
+    HEADER = struct.Struct('<IIBBI')
+
+    @classmethod
+    def shape(cls, record):
+        key, value = record
+        integers = 0
+        for i, part in enumerate(key):
+            if isinstance(part, (int, long)) and not isinstance(part, bool):
+                integers |= 1 << i
+        return (len(key), len(value), integers)
+
+    @classmethod
+    def encode_block(cls, records):
+        key_length, value_length, integer_mask = StateCodec.shape(records[0])
+        integer_columns = [i for i in range(key_length) if integer_mask & (1 << i)]
+        string_columns = [i for i in range(key_length) if not integer_mask & (1 << i)]
+        # index 0 of the string table stands for `None`
+        strings = { None: 0 }
+        indices = array.array('I')
+        integers = []
+        values = array.array('d')
+        for record in records:
+            if StateCodec.shape(record) != (key_length, value_length, integer_mask):
+                raise ValueError('State records of a block must have the same shape')
+            key, value = record
+            for i in string_columns:
+                part = key[i]
+                if part not in strings:
+                    if not isinstance(part, basestring) or u'\x00' in part:
+                        raise TypeError('Cannot encode state key part %r' % (part,))
+                    strings[part] = len(strings)
+                indices.append(strings[part])
+            for i in integer_columns:
+                integers.append(key[i])
+            values.extend(value)
+
+        table = [None] * len(strings)
+        for string, index in strings.items():
+            table[index] = string.encode('utf-8') if isinstance(string, unicode) else string
+        table = '\x00'.join(table[1:])
+        body = [StateCodec.HEADER.pack(len(table), len(records), key_length, value_length, integer_mask), table]
+        if sys.byteorder != 'little':
+            indices.byteswap()
+            values.byteswap()
+        body.append(indices.tostring())
+        body.append(struct.pack('<%dq' % len(integers), *integers))
+        body.append(values.tostring())
+        return StateCodec.MAGIC + zlib.compress(''.join(body))
+
+    @classmethod
+    def decode_block(cls, block):
+        if block[:len(StateCodec.MAGIC)] != StateCodec.MAGIC:
+            raise ValueError('Not a state block')
+        body = zlib.decompress(block[len(StateCodec.MAGIC):])
+        table_length, record_count, key_length, value_length, integer_mask = StateCodec.HEADER.unpack_from(body, 0)
+        integer_columns = [i for i in range(key_length) if integer_mask & (1 << i)]
+        string_columns = [i for i in range(key_length) if not integer_mask & (1 << i)]
+        offset = StateCodec.HEADER.size + table_length
+        table = [None] + body[StateCodec.HEADER.size:offset].decode('utf-8').split(u'\x00')
+
+        indices = array.array('I')
+        values = array.array('d')
+        indices_end = offset + indices.itemsize * record_count * len(string_columns)
+        indices.fromstring(body[offset:indices_end])
+        integers_end = indices_end + 8 * record_count * len(integer_columns)
+        integers = struct.unpack_from('<%dq' % (record_count * len(integer_columns)), body, indices_end)
+        values.fromstring(body[integers_end:integers_end + values.itemsize * record_count * value_length])
+        if sys.byteorder != 'little':
+            indices.byteswap()
+            values.byteswap()
+
+        # regroup the flat columns into key tuples and value lists
+        if not integer_columns:
+            parts = iter(map(table.__getitem__, indices))
+            keys = itertools.izip(*[parts] * key_length)
+        else:
+            columns = [None] * key_length
+            for j, i in enumerate(string_columns):
+                columns[i] = map(table.__getitem__, indices[j::len(string_columns)])
+            for j, i in enumerate(integer_columns):
+                columns[i] = integers[j::len(integer_columns)]
+            keys = itertools.izip(*columns)
+        value_parts = iter(values)
+        return itertools.izip(keys, itertools.imap(list, itertools.izip(*[value_parts] * value_length)))
+
+    @classmethod
+    def encode_partition(cls, iterator):
+        block = []
+        block_shape = None
+        for record in iterator:
+            shape = StateCodec.shape(record)
+            if block and (len(block) >= StateCodec.BLOCK_SIZE or shape != block_shape):
+                yield StateCodec.encode_block(block)
+                block = []
+            block.append(record)
+            block_shape = shape
+        if block:
+            yield StateCodec.encode_block(block)
+
 class DataSource:
     def __init(self):
         pass
@@ -242,27 +774,118 @@ class DataSource:
     def load(self, sparkContext, path, isPrev):
         raise NotImplementedError('Abstract')
         
+    def loadJson(self, container, path):
+        raise NotImplementedError('Abstract')
+
     def saveAsJson(self, payload, container, path):
         raise NotImplementedError('Abstract')
 
+    def saveAllAsJson(self, items, container):
+        # save an iterable of (path, payload) and return the number saved
+        saved = 0
+        for path, payload in items:
+            self.saveAsJson(payload, container, path)
+            saved += 1
+        return saved
+
     def saveAsText(self, rdd, container, path):
         raise NotImplementedError('Abstract')
 
-    def deleteAllBut(self, container, exceptFolderName):
+    def loadBinary(self, sparkContext, container, path):
+        raise NotImplementedError('Abstract')
+
+    def saveAsBinary(self, rdd, container, path):
+        raise NotImplementedError('Abstract')
+
+    def loadState(self, sparkContext, container, path):
+        return self.loadBinary(sparkContext, container, path).flatMap(StateCodec.decode_block)
+
+    def saveState(self, rdd, container, path):
+        # encoding keeps the partitioning, so every partition still ends up in its own part file
+        self.saveAsBinary(rdd.mapPartitions(StateCodec.encode_partition, preservesPartitioning=True), container, path)
+
+    def deleteAllBut(self, container, exceptFolderNames):
+        raise NotImplementedError('Abstract')
+
+    def deletePaths(self, container, paths):
+        raise NotImplementedError('Abstract')
+
+    def deletePrefix(self, container, prefix):
+        raise NotImplementedError('Abstract')
+
+    def createContainer(self, container):
+        raise NotImplementedError('Abstract')
+
+    def loadKeywordEntities(self):
         raise NotImplementedError('Abstract')
 
-'''Simple class for loading and saving to local file system.
+    def loadKeywordFilterEntities(self):
+        raise NotImplementedError('Abstract')
+
+'''Entity of a keyword or filter json lines file, with the same attributes
+as the table storage entity it stands in for.
+'''
+class FileEntity:
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+TEXT_COMPRESSION_CODEC = 'org.apache.hadoop.io.compress.GzipCodec'
+
+'''Simple class for loading and saving to local file system, for offline
+runs and benchmarks. Containers are folders, and the keyword and filter
+tables are json lines files named by KEYWORD_TABLE_NAME and
+FILTER_TABLE_NAME (either absolute or relative to the INPUT_CONTAINER
+folder), with one entity per line, e.g. `{"en_term": "Rain", "ar_term":
+"..."}` and `{"filteredTerms": "[\\"rain\\", \\"dance\\"]"}`.
+Small files are optionally read through a memory map, and text output is
+optionally gzip compressed.
 '''
 class FileDataSource(DataSource):
-    def __init__(self):
-        pass
+    def __init__(self, compress=False, use_mmap=False):
+        self.compress = compress
+        self.use_mmap = use_mmap
+
+    def read(self, path):
+        with open(path, 'rb') as file:
+            if not self.use_mmap or os.fstat(file.fileno()).st_size == 0:
+                return file.read()
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return mapped[:]
+            finally:
+                mapped.close()
+
+    def table_path(self, table):
+        if os.path.isabs(table):
+            return table
+        return os.path.join(getenv('INPUT_CONTAINER'), table)
+
+    def load_entities(self, table):
+        lines = self.read(self.table_path(table)).decode('utf-8').splitlines()
+        return [FileEntity(json.loads(line)) for line in lines if line.strip()]
+
+    def loadKeywordEntities(self):
+        return self.load_entities(getenv('KEYWORD_TABLE_NAME'))
+
+    def loadKeywordFilterEntities(self):
+        return self.load_entities(getenv('FILTER_TABLE_NAME'))
    
-    def download(self, container, path):
-        return
+    def download(self, folder, path):
+        # mirror a blob download: the file ends up at `path`
+        source = os.path.join(folder, path)
+        if os.path.exists(source) and os.path.abspath(source) != os.path.abspath(path):
+            shutil.copyfile(source, path)
         
     def load(self, sparkContext, folder, path):
-        return sparkContext.textFile(folder + path)
+        paths = path if type(path) == list else [path]
+        return sparkContext.textFile(','.join(folder + cur for cur in paths))
         
+    def loadJson(self, folder, path):
+        path = folder + '/' + path
+        if not os.path.exists(path):
+            return None
+        return json.loads(self.read(path).decode('utf-8'))
+
     def saveAsJson(self, payload, folder, path):
         path = path.replace('(', '').replace(')', '').replace("'", '').replace(',', '/').replace(' ', '')
         path = folder + '/' + path
@@ -270,118 +893,347 @@ class FileDataSource(DataSource):
         if not os.path.exists(d):
             os.makedirs(d)
         json_string = json.dumps(payload, ensure_ascii=False).encode('utf-8')
-        print json_string
         try:
-            with io.open(path, 'w', encoding='utf-8') as file:
-                file.write(unicode(json_string))
+            # write aside and rename, so readers never see a partial file
+            with io.open(path + '.tmp', 'w', encoding='utf-8') as file:
+                file.write(json_string.decode('utf-8'))
+            os.rename(path + '.tmp', path)
         except Exception as e:
-            print 'Failed to save %s: %s' % (path, str(e))
+            logger.error('Failed to save %s: %s', path, str(e))
             raise
             
     def saveAsText(self, rdd, folder, path):
         path = folder + path
         try:
-            rdd.saveAsTextFile(path)
+            if self.compress:
+                rdd.saveAsTextFile(path, TEXT_COMPRESSION_CODEC)
+            else:
+                rdd.saveAsTextFile(path)
+        except Exception as e:
+            logger.error('Failed to save %s: %s', path, str(e))
+            raise
+
+    def loadBinary(self, sparkContext, folder, path):
+        paths = path if type(path) == list else [path]
+        return sparkContext.pickleFile(','.join(folder + cur for cur in paths))
+
+    def saveAsBinary(self, rdd, folder, path):
+        path = folder + path
+        try:
+            rdd.saveAsPickleFile(path, 1)
         except Exception as e:
-            print 'Failed to save %s: %s' % (path, str(e))
+            logger.error('Failed to save %s: %s', path, str(e))
             raise
 
-    def deleteAllBut(self, folder, exceptFolderName):
+    def deleteAllBut(self, folder, exceptFolderNames):
+        if type(exceptFolderNames) != list:
+            exceptFolderNames = [exceptFolderNames]
         prev_root = folder
+        if not os.path.isdir(prev_root):
+            return
         for name in os.listdir(prev_root):
             if os.path.isdir(prev_root + '/' + name):
-                if not name == output_path and not name == now:
+                if not name in exceptFolderNames:
                     try:
                         shutil.rmtree(prev_root + '/' + name)
                     except Exception as e:
-                        print 'Failed to delete %s: %s' % (name, str(e))
+                        logger.error('Failed to delete %s: %s', name, str(e))
                         raise
 
-def write_partition(data_source, value_mapper=lambda x:x):
-    print 'inside write_partition'
-    def writer(iterator):
-        for row in iterator:
-            try: 
-                key = row[0]
-                if type(row[1]) == list:
-                    payload = [value_mapper(elt) for elt in row[1]]
-                else:
-                    payload = [value_mapper(cur) for cur in row[1].items()]
-                output_path = ('/'.join(key) if type(key) == list else str(key).replace('(', '').replace(')', '').replace("'", '').replace(',', '/').replace(' ', '')) + '.json'
-                data_source.save(payload, output_path)
-            except Exception as e:
-                raise TypeError('Failed to cope with %s => %s: %s' % (json.dumps(row[0]), json.dumps(row[1]), str(e)))
-        yield None
-    return writer
-
+    def deletePaths(self, folder, paths):
+        # the checksum files hadoop writes next to a file go with it
+        deleted = 0
+        for path in paths:
+            path = folder + '/' + path.lstrip('/')
+            checksum = os.path.join(os.path.dirname(path), '.%s.crc' % os.path.basename(path))
+            for name in [path, checksum]:
+                if os.path.exists(name):
+                    os.remove(name)
+                    deleted += 1
+        return deleted
+
+    def deletePrefix(self, folder, prefix):
+        path = folder + '/' + prefix.strip('/')
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    def createContainer(self, folder):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+from azure.common import AzureMissingResourceHttpError
 from azure.storage.blob import BlobService
-import logging
-
-logger = logging.getLogger(__name__)
+import Queue
+import threading
+
+BLOB_IO_WORKERS = 16
+BLOB_IO_MAX_IN_FLIGHT = 64
+BLOB_IO_RETRIES = 3
+BLOB_IO_BACKOFF = 0.5
+BLOB_LIST_PAGE_SIZE = 5000
+
+'''Runs blob requests on a pool of threads. Every thread creates its own
+blob service on first use and reuses it (and its connection) for all its
+requests; at most `max_in_flight` requests are queued or running at a
+time, so callers can stream any number of requests through the pool.
+Failed requests are retried with exponential backoff, except for missing
+blobs and containers.
+'''
+class BlobPool:
+    def __init__(self, service_factory, workers=BLOB_IO_WORKERS, max_in_flight=BLOB_IO_MAX_IN_FLIGHT, retries=BLOB_IO_RETRIES, backoff=BLOB_IO_BACKOFF):
+        self.service_factory = service_factory
+        self.workers = workers
+        self.max_in_flight = max(max_in_flight, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+
+    def service(self):
+        if getattr(self.local, 'service', None) == None:
+            self.local.service = self.service_factory()
+        return self.local.service
+
+    def call(self, request):
+        # run `request(service)` on the calling thread
+        attempt = 0
+        while True:
+            try:
+                return request(self.service())
+            except AzureMissingResourceHttpError:
+                raise
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (1 + random.random())
+                logger.warning('Retrying blob request in %.1fs after: %s', delay, str(e))
+                time.sleep(delay)
+                attempt += 1
+
+    def run(self, request, items):
+        # run `request(service, item)` for every item and return the number
+        # of items; once a request fails, the remaining items are skipped
+        tasks = Queue.Queue()
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        errors = []
+        done = object()
+
+        def work():
+            while True:
+                item = tasks.get()
+                if item is done:
+                    return
+                try:
+                    if not errors:
+                        self.call(lambda service: request(service, item))
+                except Exception as e:
+                    errors.append((item, e))
+                finally:
+                    slots.release()
+
+        threads = [threading.Thread(target=work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        count = 0
+        try:
+            for item in items:
+                if errors:
+                    break
+                slots.acquire()
+                tasks.put(item)
+                count += 1
+        finally:
+            for thread in threads:
+                tasks.put(done)
+            for thread in threads:
+                thread.join()
+        if errors:
+            item, e = errors[0]
+            raise IOError('Blob request for %s failed: %s' % (str(item), str(e)))
+        return count
+
+def create_blob_service():
+    # the storage emulator and other endpoints are reached through a connection string
+    connection_string = getenv('STORAGE_CONNECTION_STRING', '')
+    if connection_string:
+        return BlobService(connection_string=connection_string)
+    return BlobService(getenv('STORAGE_ACCOUNT'), getenv('STORAGE_KEY'))
+
+def ignore_missing(request):
+    def ignoring(service, item):
+        try:
+            request(service, item)
+        except AzureMissingResourceHttpError:
+            pass
+    return ignoring
 
 class BlobSource(DataSource):
-    def __init__(self):
+    def __init__(self, service_factory=create_blob_service):
         self.storage_account = getenv('STORAGE_ACCOUNT')
-        self.blob_service = BlobService(self.storage_account, getenv('STORAGE_KEY'))
+        self.service_factory = service_factory
+        self.pool = self.create_pool()
+
+    def create_pool(self):
+        return BlobPool(self.service_factory,
+                        getenv('BLOB_IO_WORKERS', BLOB_IO_WORKERS, int),
+                        getenv('BLOB_IO_MAX_IN_FLIGHT', BLOB_IO_MAX_IN_FLIGHT, int),
+                        getenv('BLOB_IO_RETRIES', BLOB_IO_RETRIES, int))
+
+    def __getstate__(self):
+        # the pool holds threads and connections, executors create their own
+        state = self.__dict__.copy()
+        del state['pool']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = self.create_pool()
+
+    @property
+    def blob_service(self):
+        return self.pool.service()
+
+    def table_service(self):
+        return TableService(account_name = getenv('STORAGE_ACCOUNT'), account_key = getenv('STORAGE_KEY'))
+
+    def loadKeywordEntities(self):
+        # query all keyword entities
+        return self.table_service().query_entities(getenv('KEYWORD_TABLE_NAME'), filter="PartitionKey eq 'Keyword'")
+
+    def loadKeywordFilterEntities(self):
+        # query all entities
+        return self.table_service().query_entities(getenv('FILTER_TABLE_NAME'))
         
+    def uri(self, container, path):
+        paths = path if type(path) == list else [path]
+        uris = []
+        for path in paths:
+            path = ('/' if path[0] != '/' else '') + path
+            uris.append('wasb://%s@%s.blob.core.windows.net%s' % (container, self.storage_account, path))
+        return ','.join(uris)
+
     def load(self, sparkContext, container, path):
-        path = ('/' if path[0] != '/' else '') + path
-        uri = 'wasb://%s@%s.blob.core.windows.net%s' % (container, self.storage_account, path)
-        print 'Loading from %s' % uri
+        uri = self.uri(container, path)
+        logger.info('Loading from %s', uri)
         return sparkContext.textFile(uri)
 
+    def loadBinary(self, sparkContext, container, path):
+        uri = self.uri(container, path)
+        logger.info('Loading binary from %s', uri)
+        return sparkContext.pickleFile(uri)
+
+    def loadJson(self, container, path):
+        path = path.lstrip('/')
+        try:
+            return json.loads(self.pool.call(lambda service: service.get_blob_to_text(container, path)))
+        except AzureMissingResourceHttpError:
+            return None
+
     def download(self, container, path):
-        print 'Downloading blob from %s/%s' % (container, path)
-        self.blob_service.get_blob_to_path(container, path, path)
-        print 'Downloaded blob to ' + path
+        logger.info('Downloading blob from %s/%s', container, path)
+        self.pool.call(lambda service: service.get_blob_to_path(container, path, path))
+        logger.info('Downloaded blob to %s', path)
+
+    def put_json(self, service, container, path, payload):
+        json_string = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        service.put_blob(container, path.lstrip('/'), json_string, 'BlockBlob', x_ms_blob_cache_control='max-age=3600', x_ms_blob_content_type='application/json')
 
     def saveAsJson(self, payload, container, path):
         path = path.lstrip('/')
-        print path
-        print 'Saving to %s/%s' % (container, path)
-        json_string = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        logger.info('Saving to %s/%s', container, path)
+        try:
+            self.pool.call(lambda service: self.put_json(service, container, path, payload))
+        except Exception as e:
+            logger.error('Failed to save %s/%s: %s', container, path, str(e))
+            raise
+
+    def saveAllAsJson(self, items, container):
         try:
-            self.blob_service.put_blob(container, path, json_string, 'BlockBlob', x_ms_blob_cache_control='max-age=3600', x_ms_blob_content_type='application/json')
+            return self.pool.run(lambda service, item: self.put_json(service, container, item[0], item[1]), items)
         except Exception as e:
-            print 'Failed to save %s/%s: %s' % (container, path, str(e))
+            logger.error('Failed to save to %s: %s', container, str(e))
             raise
 
     def saveAsText(self, rdd, container, path):
         path = path.lstrip('/')
         path = '/' + path
-        print 'Saving rdd to %s%s' % (container, path)
+        logger.info('Saving rdd to %s%s', container, path)
         uri = 'wasb://%s@%s.blob.core.windows.net%s' % (container, self.storage_account, path)
         try:
             rdd.saveAsTextFile(uri)
         except Exception as e:
-            print 'Failed to save %s%s: %s' % (container, path, str(e))
+            logger.error('Failed to save %s%s: %s', container, path, str(e))
             raise 
 
-    def deleteAllBut(self, container, exceptFolderName):
-        print 'deleteAllBut called'
+    def saveAsBinary(self, rdd, container, path):
+        path = '/' + path.lstrip('/')
+        logger.info('Saving binary rdd to %s%s', container, path)
         try:
-            bloblistingresult = self.blob_service.list_blobs(container) 
-            for i in bloblistingresult:
-                print i.name
-                if not exceptFolderName in i.name:
-                    try:
-                        print 'deleting'
-                        self.blob_service.delete_blob(container, i.name)
-                        print 'deleted'
-                    except Exception as e:
-                        print 'Failed to delete %s/%s: %s' % (container, i.name, str(e))
-                        raise
+            rdd.saveAsPickleFile(self.uri(container, path), 1)
         except Exception as e:
-            print 'Failed to list things in %s: %s' % (container, str(e))
+            logger.error('Failed to save %s%s: %s', container, path, str(e))
+            raise
+
+    def listBlobNames(self, container, prefix=None):
+        # page through the listing with its continuation markers
+        marker = None
+        while True:
+            page = self.pool.call(lambda service: service.list_blobs(container, prefix=prefix, marker=marker, maxresults=BLOB_LIST_PAGE_SIZE))
+            for blob in page:
+                yield blob.name
+            marker = getattr(page, 'next_marker', None)
+            if not marker:
+                return
+
+    def deleteAllBut(self, container, exceptFolderNames):
+        # delete every blob but the given top level folders and blobs
+        if type(exceptFolderNames) != list:
+            exceptFolderNames = [exceptFolderNames]
+        kept = set(name.strip('/') for name in exceptFolderNames)
+        names = (name for name in self.listBlobNames(container) if name.split('/')[0] not in kept)
+        try:
+            deleted = self.pool.run(ignore_missing(lambda service, name: service.delete_blob(container, name)), names)
+            logger.info('Deleted %d blobs from %s', deleted, container)
+        except Exception as e:
+            logger.error('Failed to delete from %s: %s', container, str(e))
             raise 
 
+    def deletePaths(self, container, paths):
+        try:
+            return self.pool.run(ignore_missing(lambda service, name: service.delete_blob(container, name)), (path.lstrip('/') for path in paths))
+        except Exception as e:
+            logger.error('Failed to delete from %s: %s', container, str(e))
+            raise
+
+    def deletePrefix(self, container, prefix):
+        # delete every blob under `prefix`, e.g. a whole folder, and the
+        # marker blob hadoop may have created for the folder itself
+        prefix = prefix.strip('/')
+        names = itertools.chain([prefix], self.listBlobNames(container, prefix + '/'))
+        try:
+            return self.pool.run(ignore_missing(lambda service, name: service.delete_blob(container, name)), names)
+        except Exception as e:
+            logger.error('Failed to delete %s/%s: %s', container, prefix, str(e))
+            raise
+
+    def createContainer(self, container):
+        self.pool.call(lambda service: service.create_container(container, fail_on_exist=False))
+
+_tokenizer = None
+
+def get_tokenizer():
+    # resolve nltk's tokenizer once per python worker rather than per call
+    global _tokenizer
+    if _tokenizer == None:
+        ensure_package_path()
+        from nltk.tokenize import wordpunct_tokenize
+        _tokenizer = wordpunct_tokenize
+    return _tokenizer
+
 class SentimentScorer:
 
     def __init__(self, lines):
         self.lookup = {}
-        self.max_len = 0        
-        ensure_package_path()
-        from nltk.tokenize import wordpunct_tokenize as tokenize
         for line in lines:
             word_data = json.loads(line)
             # capture both positive and negative, choose one at scoring time
@@ -397,40 +1249,50 @@ class SentimentScorer:
                 if term in self.lookup:
                     existing_scores = self.lookup[term]
                 self.lookup[term] = (max(pos_score, existing_scores[0]), max(neg_score, existing_scores[1]))
-                # update the maximum token length to check
-                self.max_len = max(len(tokenize(term)), self.max_len)
+        # compile the lookup into a token trie; a term matches the tokens
+        # whose space joined form equals it, i.e. its space separated parts
+        self.trie = {}
+        for term, scores in self.lookup.items():
+            parts = term.split(' ')
+            if '' in parts:
+                continue
+            node = self.trie
+            for part in parts:
+                node = node.setdefault(part, {})
+            # the `None` entry of a node holds the scores of the term ending there
+            node[None] = scores
     
     def score(self, sentence):
         # track both positive and negative scores for sentence
         pos_score, neg_score = 0., 0.
         # assuming no contextual forms are used for Arabic
-        ensure_package_path()
-        from nltk.tokenize import wordpunct_tokenize as tokenize
-        tokens = tokenize(sentence.lower())
+        tokens = get_tokenizer()(sentence.lower())
+        token_count = len(tokens)
         term_count = 0
-        # using nested while loops here to accomodate early termination of 
-        # inner loop, and updating the index of the outer loop based on the
-        #  number of tokens used in the sub-phrase
+        # walk the trie from each position to find the longest matching
+        # phrase, then continue after the tokens used by that phrase
         i = 0
-        while i < len(tokens):
-            matched = False
-            j = min(self.max_len, len(tokens) - i)
-            # check phrase lengths up to `max_len`
-            while j > 0 and (i + j) <= len(tokens):
-                sub_tokens = tokens[i : i + j]
-                sub_word = ' '.join(sub_tokens)
-                # if a match exist for phrase, update scores and counts
-                if sub_word in self.lookup:
-                    sub_word_scores = self.lookup[sub_word]
-                    pos_score += sub_word_scores[0]
-                    neg_score += sub_word_scores[1]
-                    term_count += 1
-                    matched = True
-                    i += j
+        while i < token_count:
+            node = self.trie.get(tokens[i])
+            j = i
+            matched_scores = None
+            matched_end = i
+            while node != None:
+                j += 1
+                if None in node:
+                    matched_scores = node[None]
+                    matched_end = j
+                if j == token_count:
                     break
-                j -= 1
+                node = node.get(tokens[j])
+            # if a match exist for phrase, update scores and counts
+            if matched_scores != None:
+                pos_score += matched_scores[0]
+                neg_score += matched_scores[1]
+                term_count += 1
+                i = matched_end
             # if not matched, skip token
-            if not matched:
+            else:
                 i += 1
         # if no terms matched, or scores are equal, return a neutral score
         if pos_score == neg_score:
@@ -442,27 +1304,88 @@ class SentimentScorer:
         else:
             return 0.5 - neg_score / term_count / 2
 
-def extract_langid(sentence):
-    ensure_package_path()
-    from langid import langid
-    message = sentence['Sentence']
-    sentence['Language'] = langid.classify(message)[0]
-    return sentence
+LANGID_BATCH_SIZE = 256
+LANGID_CACHE_SIZE = 50000
+
+class LRUCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value != None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.capacity:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+    def __len__(self):
+        return len(self.entries)
+
+def normalize_langid_text(text):
+    # collapse whitespace so that reposts differing only in spacing share a cache entry
+    return u' '.join(text.split())
+
+'''Language identification with a single langid model per python worker.
+Messages are classified a batch at a time: the feature vectors of the
+batch are stacked so that the naive bayes scoring is one matrix product
+rather than one per message, and the labels of recently seen texts are
+kept in a bounded LRU cache since retweets and reposts are common.
+'''
+class LanguageClassifier:
+    def __init__(self, cache_size=LANGID_CACHE_SIZE):
+        ensure_package_path()
+        from langid.langid import LanguageIdentifier, model
+        self.identifier = LanguageIdentifier.from_modelstring(model)
+        self.cache = LRUCache(cache_size)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['cache_size'])
+
+    def classify_uncached(self, texts):
+        identifier = self.identifier
+        if np == None or len(texts) == 1:
+            return [identifier.classify(text)[0] for text in texts]
+        features = np.array([identifier.instance2fv(text) for text in texts])
+        # the normalization of langid is monotonic, so the arg max of the
+        # log-probabilities is the classified language
+        log_probabilities = np.dot(features, identifier.nb_ptc) + identifier.nb_pc
+        return [str(identifier.nb_classes[i]) for i in np.argmax(log_probabilities, axis=1)]
+
+    def classify(self, texts):
+        # returns the language of each text and the number of cache hits;
+        # the cache is keyed by the normalized text, but langid is given
+        # the original one of the first text seen for each key
+        keys = [normalize_langid_text(text) for text in texts]
+        languages = [self.cache.get(key) for key in keys]
+        pending = {}
+        for key, text, language in zip(keys, texts, languages):
+            if language == None and not key in pending:
+                pending[key] = text
+        if pending:
+            pending_keys = sorted(pending)
+            classified = dict(zip(pending_keys, self.classify_uncached([pending[key] for key in pending_keys])))
+            for key, language in classified.iteritems():
+                self.cache.put(key, language)
+            languages = [language if language != None else classified[key] for key, language in zip(keys, languages)]
+        return languages, len(texts) - len(pending)
 
 def download_sentiment_data(data_source):
     input_container = getenv('SENTIMENT_CONTAINER')
     model_path = getenv('SENTIMENT_MODEL')
     data_source.download(input_container, model_path)
 
-def load_sentiment_scorer(data_source):
+def load_sentiment_lines(data_source):
     download_sentiment_data(data_source)
     model_path = getenv('SENTIMENT_MODEL')
     model_file = open(model_path, 'r')
-    model_file_lines = model_file.readlines()
-    return SentimentScorer(model_file_lines)
-
-def compute_sentiment(rdd, scorer):
-    return rdd.map(lambda x: compute_sentiment_sentence(x, scorer))
+    return model_file.readlines()
 
 def compute_sentiment_sentence(sentence, scorer):
     sentence['Sentiment'] = scorer.score(sentence['Sentence'])
@@ -470,15 +1393,9 @@ def compute_sentiment_sentence(sentence, scorer):
 
 from azure.storage.table import TableService
 
-def get_keywords():    
-    # get table service reference
-    account_name = getenv('STORAGE_ACCOUNT')
-    account_key = getenv('STORAGE_KEY')
-    keyword_table = getenv('KEYWORD_TABLE_NAME')
-    table_service = TableService(account_name = account_name, account_key = account_key)
-
-    # query all keyword entities
-    keywords = table_service.query_entities(keyword_table, filter="PartitionKey eq 'Keyword'")
+def get_keyword_terms(data_source):
+    # get all keyword entities
+    keywords = data_source.loadKeywordEntities()
 
     # separate each keyword by language
     arKeywords = {}
@@ -486,34 +1403,98 @@ def get_keywords():
     for keyword in keywords:
         # map each keyword by its canonical form (currently lowercase English)
         canonicalKeyword = keyword.en_term.lower()
-        # pre-compile regex for each keyword
-        arKeywordRegex = create_keyword_regex(keyword.ar_term)
-        enKeywordRegex = create_keyword_regex(keyword.en_term)
-        arKeywords[canonicalKeyword] = arKeywordRegex
-        enKeywords[canonicalKeyword] = enKeywordRegex
+        arKeywords[canonicalKeyword] = keyword.ar_term
+        enKeywords[canonicalKeyword] = keyword.en_term
 
     return {'ar': arKeywords, 'en': enKeywords}
 
-def get_keyword_filters():
-    # get table service reference
-    account_name = getenv('STORAGE_ACCOUNT')
-    account_key = getenv('STORAGE_KEY')
-    filter_table = getenv('FILTER_TABLE_NAME')
-    table_service = TableService(account_name = account_name, account_key = account_key)
-    # query all entities
-    rows = table_service.query_entities(filter_table)
-    # create a list of conjunct regexes
-    return [ [ create_keyword_regex(term) for term in json.loads(row.filteredTerms) ] for row in rows ]
+def build_keyword_matchers(terms):
+    # pre-compile a single matcher for all keywords of each language
+    return dict((language, PhraseMatcher(languageTerms)) for language, languageTerms in terms.items())
+
+def get_keyword_filter_terms(data_source):
+    # get all filter entities
+    rows = data_source.loadKeywordFilterEntities()
+    # the conjunct terms of every row
+    return [ json.loads(row.filteredTerms) for row in rows ]
+
+def model_version(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+'''A model shipped to the executors as a broadcast variable of its raw data
+rather than captured in every task closure. Each python worker builds the
+model (tries, indexes, regexes) from that data once, when a task first asks
+for it, and keeps it on the broadcast object, which pyspark holds on to for
+the lifetime of the worker. The version hash of the data travels with both
+the broadcast and the task, so a worker never uses a stale model.
+'''
+class BroadcastModel:
+    def __init__(self, sparkContext, name, data, builder):
+        self.name = name
+        self.version = model_version(data)
+        self.builder = builder
+        self.broadcast = sparkContext.broadcast({ 'version': self.version, 'data': data })
+
+    def value(self):
+        cached = getattr(self.broadcast, 'model', None)
+        if cached == None or cached[0] != self.version:
+            payload = self.broadcast.value
+            if payload['version'] != self.version:
+                raise ValueError('Stale %s model: expected version %s but got %s' % (self.name, self.version, payload['version']))
+            cached = (self.version, self.builder(payload['data']))
+            self.broadcast.model = cached
+        return cached[1]
 
 def create_keyword_regex(keyword):
-    # import nltk
-    ensure_package_path()
-    from nltk.tokenize import wordpunct_tokenize as tokenize
-    tokens = tokenize(keyword)
+    tokens = get_tokenizer()(keyword)
     pattern = '\\s+'.join(tokens)
     pattern = '\\b%s\\b' % pattern
     return re.compile(pattern, re.I | re.UNICODE)
 
+# same tokens as nltk's `wordpunct_tokenize`, but keeping their offsets
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]+', re.UNICODE | re.MULTILINE | re.DOTALL)
+WORD_TOKEN_PATTERN = re.compile(r'\w+$', re.UNICODE)
+
+'''Matches many phrases against a sentence in a single pass.
+Phrases made only of word tokens are compiled into a token trie; since
+`create_keyword_regex` anchors them with `\\b` and joins their tokens with
+`\\s+`, they match exactly when the same lowercase tokens appear in the
+sentence separated by whitespace. Any other phrase keeps its regex.
+'''
+class PhraseMatcher:
+    def __init__(self, phrases):
+        self.trie = {}
+        self.regexes = []
+        for phrase_id, phrase in phrases.items():
+            tokens = [token.lower() for token in TOKEN_PATTERN.findall(phrase)]
+            if tokens and all(WORD_TOKEN_PATTERN.match(token) for token in tokens):
+                node = self.trie
+                for token in tokens:
+                    node = node.setdefault(token, {})
+                # the `None` entry of a node lists the phrases ending there
+                node.setdefault(None, []).append(phrase_id)
+            else:
+                self.regexes.append((phrase_id, create_keyword_regex(phrase)))
+
+    def matches(self, text):
+        matched = set()
+        tokens = [(m.group().lower(), m.start(), m.end()) for m in TOKEN_PATTERN.finditer(text)]
+        for i in range(len(tokens)):
+            node = self.trie.get(tokens[i][0])
+            j = i
+            while node is not None:
+                if None in node:
+                    matched.update(node[None])
+                j += 1
+                # consecutive phrase tokens must be separated by whitespace
+                if j == len(tokens) or tokens[j][1] == tokens[j - 1][2]:
+                    break
+                node = node.get(tokens[j][0])
+        for phrase_id, regex in self.regexes:
+            if phrase_id not in matched and regex.search(text):
+                matched.add(phrase_id)
+        return matched
+
 def extract_keywords(sentence, keywords):
     # check if there are keywords for the sentence language
     language = sentence['Language']
@@ -522,121 +1503,895 @@ def extract_keywords(sentence, keywords):
         keywordMatches = []
         if languageKeywords != None:
             message = sentence['Sentence']
-            # tokenize the sentence
-            for keyword in sorted(languageKeywords):
-                keywordRegex = languageKeywords[keyword]
-                if keywordRegex.search(message):
-                    # if match, add keyword canonical form to list
-                    keywordMatches.append(keyword)
+            # match all keywords in one pass, keeping the canonical forms sorted
+            keywordMatches = sorted(languageKeywords.matches(message))
         sentence['Keywords'] = keywordMatches
     return sentence
 
+'''Index over conjunctive noise filters, each a list of terms that must all
+appear in a sentence. All distinct terms are matched in one PhraseMatcher
+pass, and a term -> filters inverted index counts the satisfied terms of
+each filter, so the cost no longer grows with the number of filters.
+'''
+class KeywordFilterIndex:
+    def __init__(self, filters):
+        term_ids = {}
+        self.filter_sizes = []
+        self.term_filters = {}
+        # like the regex loop, a filter without terms matches every sentence
+        self.matches_all = False
+        for filter_id, conjunction in enumerate(filters):
+            filter_terms = set(term_ids.setdefault(term, len(term_ids)) for term in conjunction)
+            if not filter_terms:
+                self.matches_all = True
+            self.filter_sizes.append(len(filter_terms))
+            for term_id in filter_terms:
+                self.term_filters.setdefault(term_id, []).append(filter_id)
+        self.matcher = PhraseMatcher(dict((term_id, term) for term, term_id in term_ids.items()))
+
+    def matches(self, text):
+        if self.matches_all:
+            return True
+        counts = {}
+        for term_id in self.matcher.matches(text):
+            for filter_id in self.term_filters[term_id]:
+                count = counts.get(filter_id, 0) + 1
+                if count == self.filter_sizes[filter_id]:
+                    return True
+                counts[filter_id] = count
+        return False
+
 def filter_by_keywords(sentence, filters):
-    for conjunction in filters:
-        matched = True
-        for r in conjunction:
-            if not r.search(sentence['Sentence']):
-                matched = False
-                break
-        if matched:
-            return False
-    return True
+    return not filters.matches(sentence['Sentence'])
 
 def normalize_message(sentence):
-    return json.dumps(sentence)
+    return fast_dumps(sentence)
+
+SENTENCE_LENGTH_BOUNDS = [5, 10, 20, 40, 80, 160]
+KEYWORDS_PER_MESSAGE_BOUNDS = [1, 2, 3, 5, 8, 13, 21]
+LOCATIONS_PER_MESSAGE_BOUNDS = [1, 2, 3, 5, 10]
+PAIR_FANOUT_BOUNDS = [10, 100, 1000, 10000, 100000]
+
+def enrich_partition(stats, stats_suffix, keywords, keyword_filters, language_classifier, scorer, batch_size=LANGID_BATCH_SIZE, fields=None):
+    # parse, validate, filter, and annotate the messages of a partition with
+    # their language, sentiment, and keywords in a single pass; the models
+    # are BroadcastModels and the outcomes are counted with accumulators
+    valid_key = 'valid_%s' % stats_suffix
+    validation_counts = stats.counts('validation_%s' % stats_suffix)
+    langid_messages = stats.counter('langid_messages')
+    langid_cache_hits = stats.counter('langid_cache_hits')
+    langid_millis = stats.counter('langid_millis')
+    stats.derive('langid_cache_hit_rate', lambda payload: float(payload['langid_cache_hits']) / payload['langid_messages'])
+    stats.derive('langid_messages_per_second', lambda payload: payload['langid_messages'] * 1000.0 / payload['langid_millis'])
+    sentence_lengths = stats.histogram('sentence_length', SENTENCE_LENGTH_BOUNDS)
+    keyword_counts = stats.histogram('keywords_per_message', KEYWORDS_PER_MESSAGE_BOUNDS)
+    location_counts = stats.histogram('locations_per_message', LOCATIONS_PER_MESSAGE_BOUNDS)
+
+    def enricher(iterator):
+        keyword_matchers = keywords.value()
+        filters = keyword_filters.value()
+        classifier = language_classifier.value()
+        sentiment_scorer = scorer.value()
+        lengths = sentence_lengths.local()
+        keywordCounts = keyword_counts.local()
+        locationCounts = location_counts.local()
+        counts = {}
+        messages = 0
+        hits = 0
+        millis = 0
+        for batch in batched(iterator, batch_size):
+            valid = []
+            for line in batch:
+                key, message = validate_message(line, stats_suffix, fields=fields)
+                counts[key] = counts.get(key, 0) + 1
+                # noisy messages are dropped before the costlier language identification
+                if key == valid_key and filter_by_keywords(message, filters):
+                    valid.append(message)
+            if not valid:
+                continue
+            start = time.time()
+            languages, batch_hits = classifier.classify([message['Sentence'] for message in valid])
+            millis += int((time.time() - start) * 1000)
+            messages += len(valid)
+            hits += batch_hits
+            for message, language in zip(valid, languages):
+                message['Language'] = language
+                compute_sentiment_sentence(message, sentiment_scorer)
+                extract_keywords(message, keyword_matchers)
+                if has_keywords(message):
+                    lengths.observe(len(message['Sentence'].split()))
+                    keywordCounts.observe(len(message['Keywords']))
+                    locationCounts.observe(len(message['Locations']))
+                    yield message
+        validation_counts.add(counts)
+        lengths.commit()
+        keywordCounts.commit()
+        locationCounts.commit()
+        langid_messages.add(messages)
+        langid_cache_hits.add(hits)
+        langid_millis.add(millis)
+    return enricher
 
 MAX_ZOOM_LEVEL = 16
 MAX_DETAIL_LIMIT = 5
 MIN_DETAIL_LIMIT = 3
+SEGMENT_ZOOM_LEVELS = range(15, 16)
+SEGMENT_BATCH_SIZE = 1024
+
+def batched(iterator, size):
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def segment(sentence):
-    created = parse(sentence['Created'])
-    source = sentence['Source'].encode('ascii')
-    sentiment = sentence['Sentiment'] if 'Sentiment' in sentence else 0.0
-    payload = [ 1.0, sentiment ]
-    # aggregate over each timespan
-    for timespanType in ['alltime', 'year', 'month', 'week', 'day', 'hour']:
-        timespanLabel = build_timespan_label(timespanType, created)
-        # aggregate over each location
-        for location in sentence['Locations']:
-            try:
-                if 'coordinates' not in location:
-                    continue
-                longitude = location['coordinates'][0]
-                latitude = location['coordinates'][1]
-                # aggregate over each zoom level
-                for zoom in range(15, 16):
-                    try:
-                        tileId = Tile.tile_id_from_lat_long(latitude, longitude, zoom)
-                        keywords = sentence['Keywords']
-                        keywordLength = len(keywords)
-                        # aggregate over each pair of keywords
-                        # since the keywords are sorted, we can choose the combination
-                        # of keywords instead of the permutation of keywords
-                        for i in range(0, keywordLength):
-                            firstKeyword = keywords[i]
-                            yield ( ('keyword', source, firstKeyword, None, timespanLabel, tileId), payload )
-                            for j in range(i + 1, keywordLength):
-                                secondKeyword = keywords[j]
-                                yield ( ('keyword', source, firstKeyword, secondKeyword, timespanLabel, tileId ), payload )
-                    except ValueError as err:
-                        yield ( ('ValueError', latitude, longitude, zoom), str(err) )
-            except TypeError as err:
-                yield ( 'TypeError', (str(err), location))
+    return segment_partition([sentence])
+
+DEFAULT_KEYWORD_PAIRS = 'all'
+PAIR_SUMMARY_FACTOR = 4
+PAIR_BROADCAST_MAX_KEYS = 4000000
+
+'''Decides which keyword pairs `segment_partition` emits for a message,
+configured with the `KEYWORD_PAIRS` spec:
+- `all` emits every pair, k(k-1)/2 of them for a message with k keywords
+- `cap:N` emits at most N pairs per message, a sample picked with the
+  message id as seed so that reruns emit the same pairs
+- `top:K[:capacity]` emits every pair, but only the K most frequent pairs
+  of each (source, timespan, tile) of the run, found by
+  `pair_candidates`, are reduced and kept; those aggregates are exact
+Single keywords are always emitted.
+'''
+class KeywordPairPolicy:
+    def __init__(self, mode='all', limit=None, capacity=None):
+        if mode not in ('all', 'cap', 'top'):
+            raise ValueError('Unknown keyword pair mode %s' % mode)
+        self.mode = mode
+        self.limit = limit
+        self.capacity = capacity
+
+    @classmethod
+    def from_spec(cls, spec):
+        parts = (spec.strip() or DEFAULT_KEYWORD_PAIRS).split(':')
+        if parts[0] == 'all':
+            return KeywordPairPolicy()
+        elif parts[0] == 'cap':
+            return KeywordPairPolicy('cap', int(parts[1]))
+        elif parts[0] == 'top':
+            capacity = int(parts[2]) if len(parts) > 2 else PAIR_SUMMARY_FACTOR * int(parts[1])
+            return KeywordPairPolicy('top', int(parts[1]), capacity)
+        raise ValueError('Unknown keyword pair mode %s' % spec)
+
+    def message_pairs(self, sentence, keywords):
+        # keywords are sorted, so each pair is (lower, higher)
+        pairs = list(itertools.combinations(keywords, 2))
+        if self.mode == 'cap' and len(pairs) > self.limit:
+            pairs = sorted(random.Random(sentence['MessageId']).sample(pairs, self.limit))
+        return pairs
+
+ALL_KEYWORD_PAIRS = KeywordPairPolicy()
+
+'''Misra-Gries summary of the keyword pairs of a (source, timespan, tile)
+holding at most `capacity` counters. Every pair seen more than
+n / (capacity + 1) times out of n is guaranteed to keep a counter, which
+undercounts it by at most that much. Summaries merge in place.
+'''
+class PairSummary(object):
+    __slots__ = ('capacity', 'counts')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, pair, weight=1):
+        counts = self.counts
+        if pair in counts:
+            counts[pair] += weight
+            return
+        if len(counts) >= self.capacity:
+            # decrement every counter, the new pair included, by the smallest
+            decrement = min(weight, min(counts.itervalues()))
+            for other in counts.keys():
+                counts[other] -= decrement
+                if counts[other] <= 0:
+                    del counts[other]
+            weight -= decrement
+        if weight > 0:
+            counts[pair] = weight
+
+    def merge(self, other):
+        counts = self.counts
+        for pair, count in other.counts.iteritems():
+            counts[pair] = counts.get(pair, 0) + count
+        if len(counts) > self.capacity:
+            threshold = sorted(counts.itervalues(), reverse=True)[self.capacity]
+            for pair in counts.keys():
+                counts[pair] -= threshold
+                if counts[pair] <= 0:
+                    del counts[pair]
+        return self
+
+    def top(self, k):
+        return sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0]))[:k]
+
+def summarize_pairs(capacity):
+    # PairSummary of every (source, timespan, tile) of a partition of
+    # `segment_partition` records
+    def summarizer(records):
+        summaries = {}
+        for key, value in records:
+            if key[0] != 'keyword' or key[3] == None:
+                continue
+            group = (key[1], key[4], key[5])
+            summary = summaries.get(group)
+            if summary == None:
+                summary = summaries[group] = PairSummary(capacity)
+            summary.add((key[2], key[3]), value.count)
+        return summaries.iteritems()
+    return summarizer
+
+def pair_candidates(segmented, top, capacity):
+    # the keys of the `top` most frequent keyword pairs of each (source,
+    # timespan, tile) of `segment_partition` records, chosen on the
+    # executors; only the summaries of every partition are shuffled
+    def top_keys(item):
+        (source, timespanLabel, tileKey), summary = item
+        return [('keyword', source, pair[0], pair[1], timespanLabel, tileKey) for pair, count in summary.top(top)]
+    return segmented.mapPartitions(summarize_pairs(capacity)) \
+        .reduceByKey(PairSummary.merge) \
+        .flatMap(top_keys)
+
+def unpack_pair_key_set(hashes):
+    keys = PairKeySet(array.array('l'))
+    keys.hashes.fromstring(hashes)
+    return keys
+
+'''The candidate pair keys of `pair_candidates`, to drop the other pairs
+before the shuffle. The keys are held as a sorted array of their portable
+hashes, which broadcasts as 8 bytes a key; a hash collision only lets an
+extra pair through, whose aggregate is exact as well.
+'''
+class PairKeySet(object):
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    @classmethod
+    def collect(cls, candidates, max_keys=PAIR_BROADCAST_MAX_KEYS):
+        # None when there are more than `max_keys` candidates
+        hashes = candidates.map(portable_hash).take(max_keys + 1)
+        if len(hashes) > max_keys:
+            return None
+        return PairKeySet(array.array('l', sorted(set(hashes))))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, key):
+        keyHash = portable_hash(key)
+        index = bisect.bisect_left(self.hashes, keyHash)
+        return index < len(self.hashes) and self.hashes[index] == keyHash
+
+    def keeps(self, kv):
+        # single keywords are always kept
+        return kv[0][3] == None or kv[0] in self
+
+    def __reduce__(self):
+        return (unpack_pair_key_set, (self.hashes.tostring(),))
+
+def filter_top_pairs(reduced, candidates, partitioner):
+    # keep the single keywords and the candidate pairs of the aggregates
+    # of `reduced`, which is partitioned by `partitioner`, so that only the
+    # candidates are shuffled to meet them
+    def keeper(items):
+        for key, (values, marks) in items:
+            if values and (key[3] == None or marks):
+                yield (key, values[0])
+    return cogroup_partitioned(reduced, candidates.map(lambda key: (key, None)), partitioner).mapPartitions(keeper, preservesPartitioning=True)
+
+def segment_partition(sentences, fanout=None, pairPolicy=ALL_KEYWORD_PAIRS):
+    # `fanout` is an optional Histogram of the records emitted per message,
+    # `pairPolicy` a KeywordPairPolicy
+    fanoutCounts = fanout.local() if fanout != None else None
+    # the messages of a partition fall into a handful of hours
+    labelsByHour = {}
+
+    for batch in batched(sentences, SEGMENT_BATCH_SIZE):
+        # gather the coordinates of the whole batch so that the tile keys
+        # for all zoom levels are computed with a single vectorized call
+        latitudes = []
+        longitudes = []
+        batchLocations = []
+        for sentence in batch:
+            locations = []
+            for location in sentence['Locations']:
+                try:
+                    if 'coordinates' not in location:
+                        continue
+                    longitude = location['coordinates'][0]
+                    latitude = location['coordinates'][1]
+                    # non-numeric coordinates raise a TypeError just like the scalar tile math
+                    longitude + 0.0, latitude + 0.0
+                    locations.append((len(latitudes), None))
+                    latitudes.append(latitude)
+                    longitudes.append(longitude)
+                except TypeError as err:
+                    locations.append((None, (str(err), location)))
+            batchLocations.append(locations)
+
+        keys = Tile.tile_keys_from_lat_long(latitudes, longitudes, Tile.MAX_ZOOM)
+        keysByZoom = [(zoom, Tile.ancestor_tile_keys(keys, zoom)) for zoom in SEGMENT_ZOOM_LEVELS]
+
+        for sentence, locations in zip(batch, batchLocations):
+            labels = build_timespan_labels(parse_created(sentence['Created']), labelsByHour)
+            source = sentence['Source'].encode('ascii')
+            sentiment = sentence['Sentiment'] if 'Sentiment' in sentence else 0.0
+            payload = SentimentAccumulator.of(sentiment)
+            keywords = sentence['Keywords']
+            pairs = pairPolicy.message_pairs(sentence, keywords)
+            if fanoutCounts != None:
+                validLocations = sum(1 for index, error in locations if error is None)
+                fanoutCounts.observe(len(TIMESPAN_TYPES) * validLocations * len(SEGMENT_ZOOM_LEVELS) * (len(keywords) + len(pairs)))
+            # aggregate over each timespan
+            for timespanType in TIMESPAN_TYPES:
+                timespanLabel = labels[timespanType]
+                # aggregate over each location
+                for index, error in locations:
+                    if error is not None:
+                        yield ( 'TypeError', error )
+                        continue
+                    # aggregate over each zoom level
+                    for zoom, zoomKeys in keysByZoom:
+                        tileKey = zoomKeys[index]
+                        if tileKey == Tile.INVALID_TILE_KEY:
+                            yield ( ('ValueError', latitudes[index], longitudes[index], zoom), 'coordinates are outside of the tile grid' )
+                            continue
+                        # aggregate over each keyword and each pair of keywords;
+                        # the packed tile key is only rendered as a tile id
+                        # when writing output
+                        for keyword in keywords:
+                            yield ( ('keyword', source, keyword, None, timespanLabel, tileKey), payload )
+                        for firstKeyword, secondKeyword in pairs:
+                            yield ( ('keyword', source, firstKeyword, secondKeyword, timespanLabel, tileKey ), payload )
+    if fanoutCounts != None:
+        fanoutCounts.commit()
 
 def aggregate_by_zoom(data):
+    # the detail map entries of an aggregate whose key ends with its tile
+    # key: one { tileKey: value } for each coarser bucket tile it shows up in
     key = data[0]
     value = data[1]
-    tileId = key[3]
-    tile = Tile.tile_from_tile_id(tileId)
-    lowLevel = tile.zoom - MAX_DETAIL_LIMIT
-    highLevel = tile.zoom - MIN_DETAIL_LIMIT
-    if tile.zoom == MAX_ZOOM_LEVEL - 1:
+    tileKey = key[-1]
+    zoom = tileKey >> Tile.KEY_ZOOM_SHIFT
+    lowLevel = zoom - MAX_DETAIL_LIMIT
+    highLevel = zoom - MIN_DETAIL_LIMIT
+    if zoom == MAX_ZOOM_LEVEL - 1:
         highLevel = MAX_ZOOM_LEVEL - 1
-    if tile.zoom == MAX_ZOOM_LEVEL:
+    if zoom == MAX_ZOOM_LEVEL:
         highLevel = MAX_ZOOM_LEVEL
-    for zoomLevel in range(lowLevel, highLevel):
-        bucketTileId = Tile.tile_id_from_lat_long(tile.center_latitude, tile.center_longitude, zoomLevel)
-        yield ( (key[0], key[1], key[2], bucketTileId), { tileId: value } )
+    for zoomLevel in range(max(lowLevel, Tile.MIN_ZOOM), highLevel):
+        yield ( key[:-1] + (Tile.ancestor_tile_key(tileKey, zoomLevel),), { tileKey: value } )
+
+def merge_detail_maps(a, b):
+    a.update(b)
+    return a
+
+def normalize_detail_map(x):
+    key, details = normalize_keys(x)
+    return (key, dict((Tile.tile_id_from_tile_key(tileKey), value) for tileKey, value in details.iteritems()))
+
+def tile_detail_maps(rdd):
+    # the detail map of every bucket tile: the aggregates of its tiles
+    # MIN_DETAIL_LIMIT to MAX_DETAIL_LIMIT zoom levels further in, with the
+    # tiles rendered as tile ids like the rest of the output
+    return rdd.flatMap(aggregate_by_zoom).reduceByKey(merge_detail_maps).map(normalize_detail_map)
         
-def merge_sentiment(a, b):
-    result = []
+COMBINER_MAX_KEYS = 100000
+
+def combine_partition(max_keys, records_counter=None, combined_counter=None):
+    # collapse duplicate keys of a partition before the shuffle; when
+    # `max_keys` keys are held, everything collected so far is emitted
+    def combiner(iterator):
+        combined = {}
+        records = 0
+        emitted = 0
+        for key, value in iterator:
+            records += 1
+            if key in combined:
+                combined[key].merge(value)
+            else:
+                if len(combined) >= max_keys:
+                    emitted += len(combined)
+                    for item in combined.iteritems():
+                        yield item
+                    combined = {}
+                # segment shares its payload between keys, so copy it
+                combined[key] = value.copy()
+        emitted += len(combined)
+        for item in combined.iteritems():
+            yield item
+        if records_counter != None:
+            records_counter.add(records)
+        if combined_counter != None:
+            combined_counter.add(emitted)
+    return combiner
+
+def parent_tiles_partition(records):
+    # re-key the aggregates of a partition by their parent tile
+    for key, value in records:
+        yield (key[:5] + (Tile.parent_tile_key(key[5]),), value)
+
+def rollup_pyramid(rdd, min_zoom, max_keys=COMBINER_MAX_KEYS, partitioner=None):
+    # add the aggregates of every coarser zoom level down to `min_zoom` to
+    # the reduced aggregates of the segment zoom level; each level is
+    # reduced from the level below it rather than from the raw records, and
+    # with `partitioner` all levels and their union are partitioned like `rdd`
+    if len(SEGMENT_ZOOM_LEVELS) != 1:
+        raise ValueError('Tile pyramids are rolled up from a single segment zoom level')
+    combiner = combine_partition(max_keys)
+    levels = [rdd]
+    for zoom in range(SEGMENT_ZOOM_LEVELS[0] - 1, max(min_zoom, Tile.MIN_ZOOM) - 1, -1):
+        # the combiner copies the values the next reduce merges into
+        level = levels[-1].mapPartitions(lambda records: combiner(parent_tiles_partition(records)))
+        if partitioner != None:
+            level = level.reduceByKey(merge_sentiment, partitioner.numPartitions, partitioner)
+        else:
+            level = level.reduceByKey(merge_sentiment)
+        level.cache()
+        levels.append(level)
+    # unlike SparkContext.union, unions of two RDDs with equal partitioners
+    # keep the partitioner
+    pyramid = levels[0]
+    for level in levels[1:]:
+        pyramid = pyramid.union(level)
+    return pyramid
+
+'''Count, sum and sum of squares of the sentiment of the messages behind
+an aggregate. Merging is associative, happens in place, and is exact for
+the counts; averages are only computed when writing output, so repeated
+incremental merges do not accumulate rounding drift.
+'''
+class SentimentAccumulator(object):
+    __slots__ = ('count', 'total', 'total_squares')
 
-    # Save count variables
-    aCount = a[0]
-    bCount = b[0]
-    totalCount = aCount + bCount
-    result.append(totalCount)
+    def __init__(self, count=0.0, total=0.0, total_squares=0.0):
+        self.count = count
+        self.total = total
+        self.total_squares = total_squares
 
-    # Compute weighted average for remaining values (except last)
-    for idx in range(1, len(a)):
-        result.append((aCount * a[idx] + bCount * b[idx]) / totalCount)
-    
-    return result
+    @classmethod
+    def of(cls, sentiment):
+        return SentimentAccumulator(1.0, sentiment, sentiment * sentiment)
 
-def increment(kv):
-    key = kv[0]
-    value = kv[1]
-    v1 = value[0]
-    v2 = value[1]
-    result = []
-    if v1 == None and not v2 == None:
-        result = v2
-    if v2 == None and not v1 == None:
-        result = v1
-    if not v1 == None and not v2 == None:
-        result = merge_sentiment(v1, v2)
-    stripped_key = tuple(k for k in key[1:])
-    return (stripped_key, result)
+    @classmethod
+    def from_values(cls, values):
+        # state written before the accumulator only has [count, average]
+        if len(values) == 2:
+            count, average = values
+            return SentimentAccumulator(count, count * average, count * average * average)
+        return SentimentAccumulator(values[0], values[1], values[2])
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        return self
+
+    def copy(self):
+        return SentimentAccumulator(self.count, self.total, self.total_squares)
+
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def variance(self):
+        if not self.count:
+            return 0.0
+        average = self.average()
+        return max(self.total_squares / self.count - average * average, 0.0)
+
+    def to_output(self):
+        # the [count, average sentiment] shape the Postgres loaders expect
+        return [self.count, self.average()]
+
+    # behave like [count, total, total_squares] for the state codec
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        return iter((self.count, self.total, self.total_squares))
+
+    def __reduce__(self):
+        return (SentimentAccumulator, (self.count, self.total, self.total_squares))
+
+    def __eq__(self, other):
+        return isinstance(other, SentimentAccumulator) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'SentimentAccumulator(%r, %r, %r)' % (self.count, self.total, self.total_squares)
+
+def merge_sentiment(a, b):
+    return a.merge(b)
+
+SKEW_SAMPLE_FRACTION = 0.01
+SKEW_MIN_SAMPLED = 10
+SKEW_MAX_HEAVY_KEYS = 100
+SALTED_KEY = 'salted'
+
+'''Partitioner for the shuffles of aggregate keys, of which a few (trending
+keywords in city center tiles) can hold a large share of the records.
+Keys found heavy in a sample of the records are salted by `salt` into
+('salted', key, split) keys that spread over several partitions, and
+are otherwise placed on partitions spread apart from each other; all
+other keys are hashed the way pyspark does. Partitioners that place the
+keys the same compare equal, so pyspark does not shuffle RDDs already
+partitioned by an equal one again.
+'''
+class SkewAwarePartitioner(object):
+    def __init__(self, numPartitions, heavy=None):
+        self.numPartitions = numPartitions
+        # heavy key => (first partition, number of splits)
+        self.heavy = heavy or {}
+
+    @classmethod
+    def from_sample(cls, rdd, numPartitions, fraction=SKEW_SAMPLE_FRACTION, max_heavy_keys=SKEW_MAX_HEAVY_KEYS, seed=0):
+        # `rdd` holds pre-aggregated records, so the sample is drawn as if
+        # from the raw records their accumulators count: a record standing
+        # for `count` of them counts as `fraction * count` sampled records,
+        # and one standing for fewer than 1 / fraction is kept with that
+        # probability and counts as one. A key is heavy when its sampled
+        # records alone exceed the average records of a partition; it gets
+        # as many splits as it exceeds it
+        def sample(index, records):
+            rng = random.Random((seed, index))
+            for key, value in records:
+                expected = fraction * value.count
+                if expected >= 1 or rng.random() < expected:
+                    yield (key, max(expected, 1.0))
+        counts = rdd.mapPartitionsWithIndex(sample).reduceByKey(lambda a, b: a + b).collectAsMap()
+        fair_share = float(sum(counts.values())) / numPartitions
+        heavy = heapq.nlargest(max_heavy_keys, (item for item in counts.iteritems() if item[1] > max(fair_share, SKEW_MIN_SAMPLED)), key=lambda item: item[1])
+        assignments = {}
+        for i, (key, count) in enumerate(heavy):
+            assignments[key] = (i * numPartitions // len(heavy), min(numPartitions, int(math.ceil(count / fair_share))))
+        return SkewAwarePartitioner(numPartitions, assignments)
+
+    def __call__(self, key):
+        if key[0] == SALTED_KEY:
+            first, splits = self.heavy[key[1]]
+            return first + key[2]
+        assignment = self.heavy.get(key)
+        if assignment != None:
+            return assignment[0]
+        return portable_hash(key)
+
+    def salt(self, index, records):
+        # spread the records of heavy keys over their splits, round robin
+        # from a different split in every partition
+        if not self.heavy:
+            for record in records:
+                yield record
+            return
+        seen = {}
+        for key, value in records:
+            assignment = self.heavy.get(key)
+            if assignment == None:
+                yield (key, value)
+            else:
+                count = seen.get(key, index)
+                seen[key] = count + 1
+                yield ((SALTED_KEY, key, count % assignment[1]), value)
+
+    def __eq__(self, other):
+        return isinstance(other, SkewAwarePartitioner) and self.numPartitions == other.numPartitions and self.heavy == other.heavy
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.numPartitions, len(self.heavy)))
+
+def reduce_skewed(rdd, partitioner, merge=merge_sentiment):
+    # reduce with the heavy keys salted, then merge the partial values of
+    # each heavy key in a second, small reduce; the result is partitioned
+    # by `partitioner`
+    salted = rdd.mapPartitionsWithIndex(lambda index, records: partitioner.salt(index, records))
+    reduced = salted.reduceByKey(merge, partitioner.numPartitions, partitioner)
+    if not partitioner.heavy:
+        return reduced
+    is_salted = lambda kv: kv[0][0] == SALTED_KEY
+    heavy = reduced.filter(is_salted).map(lambda kv: (kv[0][1], kv[1])).reduceByKey(merge, partitioner.numPartitions, partitioner)
+    return reduced.filter(lambda kv: not is_salted(kv)).union(heavy)
+
+def cogroup_partitioned(rdd, other, partitioner):
+    # `rdd.cogroup(other)` on `partitioner`: a side already partitioned by
+    # an equal partitioner is not shuffled again
+    n = partitioner.numPartitions
+    tagged = rdd.partitionBy(n, partitioner).mapValues(lambda value: (0, value)) \
+        .union(other.partitionBy(n, partitioner).mapValues(lambda value: (1, value)))
+    def split(values):
+        new_values = []
+        prev_values = []
+        for side, value in values:
+            (new_values if side == 0 else prev_values).append(value)
+        return (new_values, prev_values)
+    return tagged.groupByKey(n, partitioner).mapValues(split)
 
 def normalize_keys(x):
+    # strip the 'keyword' discriminator and render the tile key as a tile id
     key = x[0]
     value = x[1]
-    stripped_key = tuple(k for k in key[1:])
+    stripped_key = key[1:-1] + (Tile.tile_id_from_tile_key(key[-1]),)
     return (stripped_key, value)
 
-def tuple_loader(line):
-    return [eval(line)]
+def output_values(x):
+    return (x[0], x[1].to_output())
+
+def state_loader(line):
+    key, value = eval(line)
+    return [(key, SentimentAccumulator.from_values(value))]
+
+def merge_state(kv):
+    # merge new and previous values of a key, remembering whether the key
+    # was updated by this run
+    key = kv[0]
+    new_values, prev_values = kv[1]
+    merged = None
+    for value in itertools.chain(new_values, prev_values):
+        merged = value if merged == None else merge_sentiment(merged, value)
+    return (key, merged, len(new_values) > 0)
+
+def restore_state_key(kv):
+    # older incremental runs stored keys without the 'keyword' discriminator,
+    # and all text state stored tile ids rather than tile keys
+    key = kv[0]
+    if key[0] != 'keyword':
+        key = ('keyword',) + tuple(key)
+    return (key[:5] + (Tile.tile_key_from_tile_id(key[5]),), kv[1])
+
+STATE_MANIFEST = 'manifest.json'
+STATE_FORMAT = 'binary'
+STATE_LAYOUT = 'hours-by-day'
+STATE_GENERATIONS = 3
+STATE_BUCKET_ZOOM = 8
+STATE_MAX_FILES = 64
+
+def state_timespan_group(timespanLabel):
+    # hours are grouped by day and days by month, so that a year of state
+    # has a few hundred partitions per area rather than thousands
+    timespanType = timespanLabel.split('-', 1)[0]
+    if timespanType == 'hour' or timespanType == 'day':
+        return timespanLabel.rsplit('-', 1)[0]
+    return timespanLabel
+
+def state_partition_key(key):
+    # partition by timespan, so that past hours / days / weeks are not read
+    # again once no new messages arrive for them, and by the tile's ancestor
+    # at STATE_BUCKET_ZOOM, so that a run only reads and rewrites the
+    # partitions of the areas it has new messages in
+    tileKey = key[5]
+    if (tileKey >> Tile.KEY_ZOOM_SHIFT) > STATE_BUCKET_ZOOM:
+        tileKey = Tile.ancestor_tile_key(tileKey, STATE_BUCKET_ZOOM)
+    return '%s_%s' % (state_timespan_group(key[4]), Tile.tile_id_from_tile_key(tileKey))
+
+def state_partition_timespan(partition):
+    return partition.split('_', 1)[0]
+
+'''Stores the all-time aggregates split into partitions, so that a run only
+reads and rewrites the partitions its new keys fall into. A manifest in
+the container maps each partition to the part file currently holding it;
+a run writes at most `max_files` part files, so a part file can hold
+several partitions. The `layout` names how `partition_key` splits the
+keys, and state split by another layout has to be rewritten in full.
+'''
+class PartitionedStateStore:
+    def __init__(self, data_source, container, partition_key, manifest_name=STATE_MANIFEST, value_decoder=SentimentAccumulator.from_values,
+                 layout=None, max_files=STATE_MAX_FILES):
+        self.data_source = data_source
+        self.container = container
+        self.partition_key = partition_key
+        self.manifest_name = manifest_name
+        self.value_decoder = value_decoder
+        self.layout = layout
+        self.max_files = max_files
+        self.manifest = data_source.loadJson(container, manifest_name)
+        # the generations that fell out of the retained ones in this run;
+        # state from before the binary format is only found by listing
+        self.dropped = []
+        self.sweep = not (self.is_initialized() or self.is_outdated())
+
+    def is_initialized(self):
+        return self.manifest != None and self.manifest.get('format') == STATE_FORMAT and self.manifest.get('layout') == self.layout
+
+    def is_outdated(self):
+        # binary state split by an earlier layout
+        return self.manifest != None and self.manifest.get('format') == STATE_FORMAT and self.manifest.get('layout') != self.layout
+
+    def reset(self):
+        # a store without a manifest may not have a container yet
+        if self.manifest == None:
+            self.data_source.createContainer(self.container)
+        # earlier generations stay around for rollbacks
+        generations = self.manifest.get('generations', []) if self.manifest != None else []
+        self.manifest = { 'format': STATE_FORMAT, 'partitions': {}, 'generations': generations }
+        if self.layout != None:
+            self.manifest['layout'] = self.layout
+
+    def generation_manifest_name(self, generation):
+        return '%s/%s' % (generation.strip('/'), self.manifest_name)
+
+    def partitions_of(self, rdd):
+        return sorted(rdd.keys().map(self.partition_key).distinct().collect())
+
+    def load(self, sparkContext, partitions):
+        stored = self.manifest['partitions']
+        wanted = set(partition for partition in partitions if partition in stored)
+        paths = sorted(set(stored[partition] for partition in wanted))
+        if not paths:
+            return sparkContext.emptyRDD()
+        rdd = self.data_source.loadState(sparkContext, self.container, paths)
+        # part files shared with other partitions are filtered down to the wanted ones
+        shared = set(paths)
+        if any(path in shared for partition, path in stored.iteritems() if partition not in wanted):
+            partition_key = self.partition_key
+            rdd = rdd.filter(lambda kv: partition_key(kv[0]) in wanted)
+        return rdd.mapValues(self.value_decoder)
+
+    def load_legacy(self, sparkContext, path):
+        # text state from before manifests existed, all folders of the container
+        return self.data_source.load(sparkContext, self.container, path).flatMap(state_loader).map(restore_state_key)
+
+    def save(self, rdd, folder):
+        if not self.is_initialized():
+            self.reset()
+        partitions = self.partitions_of(rdd)
+        if not partitions:
+            return
+        # one output partition, and thus one part file, per run of adjacent
+        # state partitions, at most `max_files` of them
+        files = min(len(partitions), max(self.max_files, 1))
+        index = dict((partition, i * files // len(partitions)) for i, partition in enumerate(partitions))
+        partition_key = self.partition_key
+        partitioned = rdd.partitionBy(files, lambda key: index[partition_key(key)])
+        self.data_source.saveState(partitioned, self.container, folder)
+        for partition, i in index.items():
+            self.manifest['partitions'][partition] = '%s/part-%05d' % (folder, i)
+
+    def commit(self, folder, retained=STATE_GENERATIONS):
+        # make the manifest the current generation: it is first written into
+        # the generation's folder, then the pointer at the root of the
+        # container is replaced with a single write, so readers see either
+        # the previous or the new generation
+        if not self.is_initialized():
+            return
+        generation = folder.strip('/')
+        previous = [cur for cur in self.manifest.get('generations', []) if cur != generation]
+        self.manifest['generation'] = generation
+        self.manifest['generations'] = ([generation] + previous)[:max(retained, 1)]
+        self.dropped = [cur for cur in previous if cur not in self.manifest['generations']]
+        self.data_source.saveAsJson(self.manifest, self.container, self.generation_manifest_name(generation))
+        self.data_source.saveAsJson(self.manifest, self.container, self.manifest_name)
+
+    def rollback(self, generation):
+        # point the state back at an earlier generation
+        generation = generation.strip('/')
+        manifest = self.data_source.loadJson(self.container, self.generation_manifest_name(generation))
+        if manifest == None:
+            raise ValueError('No manifest for generation %s in %s' % (generation, self.container))
+        # the later generations are dropped
+        current = self.manifest.get('generations', []) if self.manifest != None else []
+        self.dropped = [cur for cur in current if cur not in manifest.get('generations', [])]
+        self.manifest = manifest
+        self.data_source.saveAsJson(self.manifest, self.container, self.manifest_name)
+
+    def save_retained(self, sparkContext, rdd, folder, is_expired, archive_container=None):
+        # save the rows of `rdd` whose partitions are not expired and drop the
+        # expired partitions from the manifest; with an archive container,
+        # the expired rows of `rdd` and the stored expired partitions are
+        # copied there instead of being dropped. `rdd` holds the complete
+        # rows of the partitions it touches, so the stored copies of those
+        # are not archived a second time
+        partition_key = self.partition_key
+        expires = lambda kv: is_expired(partition_key(kv[0]))
+        self.save(rdd.filter(lambda kv: not expires(kv)), folder)
+        stored = self.manifest['partitions']
+        expired = sorted(partition for partition in stored if is_expired(partition))
+        if archive_container:
+            archived = rdd.filter(expires)
+            touched = set(self.partitions_of(archived)) if expired else set()
+            untouched = [partition for partition in expired if partition not in touched]
+            if untouched:
+                archived = archived.union(self.load(sparkContext, untouched))
+            if untouched or not archived.isEmpty():
+                self.data_source.saveState(archived, archive_container, folder)
+        for partition in expired:
+            del stored[partition]
+        return expired
+
+    def referenced_folders(self, manifest=None):
+        manifest = manifest or self.manifest
+        return sorted(set(path.strip('/').split('/')[0] for path in manifest['partitions'].values()))
+
+    def retained_folders(self):
+        # the folders of the retained generations and of the partitions they refer to
+        folders = set(self.referenced_folders())
+        for generation in self.manifest.get('generations', []):
+            manifest = self.data_source.loadJson(self.container, self.generation_manifest_name(generation))
+            if manifest != None:
+                folders.add(generation)
+                folders.update(self.referenced_folders(manifest))
+        return sorted(folders)
+
+    def generation_manifests(self, generations):
+        manifests = (self.data_source.loadJson(self.container, self.generation_manifest_name(generation)) for generation in generations)
+        return [manifest for manifest in manifests if manifest != None]
+
+    def delete_unreferenced(self):
+        # delete the part files the dropped generations referred to and the
+        # retained ones do not, and the folders left without references
+        if self.sweep:
+            self.data_source.deleteAllBut(self.container, self.retained_folders() + [self.manifest_name])
+            self.sweep = False
+        if not self.dropped:
+            return
+        current = self.manifest.get('generation')
+        retained = [self.manifest] + self.generation_manifests(cur for cur in self.manifest['generations'] if cur != current)
+        referenced = set(path.strip('/') for manifest in retained for path in manifest['partitions'].values())
+        kept = set(self.manifest['generations']) | set(path.split('/')[0] for path in referenced)
+        paths = set(path.strip('/') for manifest in self.generation_manifests(self.dropped)
+                    for path in manifest['partitions'].values()) - referenced
+        folders = sorted((set(path.split('/')[0] for path in paths) | set(self.dropped)) - kept)
+        paths = [path for path in paths if path.split('/')[0] not in folders]
+        paths += [self.generation_manifest_name(generation) for generation in self.dropped if generation in kept]
+        self.data_source.deletePaths(self.container, sorted(paths))
+        for folder in folders:
+            self.data_source.deletePrefix(self.container, folder)
+        logger.info('Deleted %d part files and %d folders from %s', len(paths), len(folders), self.container)
+        self.dropped = []
+
+    def delete_unreferenced_async(self):
+        # old generations are garbage collected while the job goes on; join
+        # the returned thread before exiting
+        def collect():
+            try:
+                self.delete_unreferenced()
+            except Exception as e:
+                logger.error('Failed to delete old generations of %s: %s', self.container, str(e))
+        thread = threading.Thread(target=collect)
+        thread.start()
+        return thread
+
+def tile_state_store(data_source, container):
+    # the all-time aggregates of the tiles
+    return PartitionedStateStore(data_source, container, state_partition_key, layout=STATE_LAYOUT,
+                                 max_files=getenv('STATE_MAX_FILES', STATE_MAX_FILES, int))
+
+def migrate_state(sc, data_source, container, folder):
+    # rewrite a text state container, or binary state split by an earlier
+    # layout, into the current partitions in one go
+    state = tile_state_store(data_source, container)
+    if state.is_initialized():
+        logger.info('State in %s is already migrated', container)
+        return
+    if state.is_outdated():
+        previous_rdd = state.load(sc, list(state.manifest['partitions']))
+    else:
+        previous_rdd = state.load_legacy(sc, '/*/part*')
+    state.reset()
+    state.save(previous_rdd, folder)
+    state.commit(folder)
+    state.delete_unreferenced()
+
+def rollback_state(data_source, container, generation):
+    # the next run starts from `generation`; the files only later
+    # generations refer to are deleted
+    state = tile_state_store(data_source, container)
+    state.rollback(generation)
+    state.delete_unreferenced()
 
 def ensure_package_path():
     # update patch for local packages
@@ -654,60 +2409,113 @@ def normalize_source(source):
 def get_sources(x):
     return [normalize_source(x['Source']), 'all']
 
-def matches_source(source):
-    if source == 'all':
-        return lambda x : True
-    
-    return lambda sentence : normalize_source(sentence['Source']) == source
+TIMESERIES_TIMESPAN_TYPES = ['month', 'week', 'day']
+TIMESERIES_TOP_KEYWORDS = 5
 
-def get_timespans(x):
-    created = parse(x['Created'])
-    return [build_timespan_label(timespanType, created) for timespanType in ["month", "week", "day"]]
+def hour_millis(created):
+    return unix_time_millis(datetime(created.year, created.month, created.day, created.hour))
 
-def matches_timespan(timespan):
-    if timespan == 'alltime':
-        return lambda x : True
-    
-    timespanType = timespan[0:timespan.index('-')]
-    return lambda sentence : build_timespan_label(timespanType, parse(sentence['Created'])) == timespan
+def hour_label_datetime(hourLabel):
+    # 'hour-2016-05-01-13:00' => datetime(2016, 5, 1, 13)
+    return timespan_label_end(hourLabel) - timedelta(hours=1)
+
+def timeseries_partition_key(key):
+    # hourly timeseries state is partitioned by day
+    return 'day-' + key[1][len('hour-'):len('hour-YYYY-MM-DD')]
 
-def split_keywords(x):
-    for k in x['Keywords']:
-        yield (('Keywords', k), 1)
+def timeseries_partition_timespans(partition):
+    # the graphs a day partition of the hourly state contributes to
+    labels = build_timespan_labels(datetime.strptime(partition, 'day-%Y-%m-%d'))
+    return [labels[timespanType] for timespanType in TIMESERIES_TIMESPAN_TYPES]
 
-def by_hour(x):
-    created = parse(x['Created'])
-    datetime_hour = datetime(created.year, created.month, created.day, created.hour)
-    yield (unix_time_millis(datetime_hour), x)
+def timeseries_hour_keys(messages):
+    # key every message by each of its (source, hour) groups
+    labelsByHour = {}
+    for message in messages:
+        hourLabel = build_timespan_labels(parse_created(message['Created']), labelsByHour)['hour']
+        for source in get_sources(message):
+            yield ((source, hourLabel), message)
 
-def create_agg_all(merge_value):
-    agg = {}
-    return lambda x: merge_value(copy.deepcopy(agg), x)
+SECTION_MAP = { 'Keywords': 'kw-' }
 
 def get_section_map():
-    return { 'Keywords': 'kw-' }
+    return SECTION_MAP
+
+def is_positive(s):
+    return not ('Sentiment' in s and s['Sentiment'] < 0.5)
+
+def unpack_keyword_counts(messages, positives, keys, mags, poss):
+    keys = keys.decode('utf-8').split(u'\x00') if keys else []
+    mag = array.array('l')
+    mag.fromstring(mags)
+    pos = array.array('l')
+    pos.fromstring(poss)
+    return KeywordCounts(messages, positives, dict(itertools.izip(keys, mag)),
+                         dict((key, count) for key, count in itertools.izip(keys, pos) if count))
+
+'''Message and keyword counts of a (source, hour): how many messages
+mention each `kw-` key (`mag`) and how many of those are positive (`pos`).
+Counts are added and merged in place. For the shuffle, the counts pickle
+as a joined string of their keys and two packed arrays rather than as
+dicts of dicts.
+'''
+class KeywordCounts(object):
+    __slots__ = ('messages', 'positives', 'mag', 'pos')
 
-def merge_sentence_all(agg, s):
-    section_map = get_section_map()
-    for t in section_map.keys():
-        for k in s[t]:
-            key = section_map[t] + k
-            if key not in agg:
-                agg[key] = { 'mag': 0, 'pos': 0 }
-            agg[key]['mag'] += 1
-            is_neg = 'Sentiment' in s and s['Sentiment'] < 0.5
-            if not is_neg:
-                agg[key]['pos'] += 1
-    return agg
-
-def merge_agg(agg1, agg2):
-    for key in set(agg1.keys()).union(set(agg2.keys())):
-        if key in agg2:
-            if key not in agg1:
-                agg1[key] = {'mag': 0, 'pos': 0}
-            agg1[key]['mag'] += agg2[key]['mag']
-            agg1[key]['pos'] += agg2[key]['pos']
-    return agg1
+    def __init__(self, messages=0, positives=0, mag=None, pos=None):
+        self.messages = messages
+        self.positives = positives
+        self.mag = mag if mag != None else {}
+        self.pos = pos if pos != None else {}
+
+    @classmethod
+    def of(cls, message):
+        return KeywordCounts().add(message)
+
+    def add(self, message):
+        positive = is_positive(message)
+        self.messages += 1
+        if positive:
+            self.positives += 1
+        mag = self.mag
+        pos = self.pos
+        for section, prefix in SECTION_MAP.iteritems():
+            for keyword in message[section]:
+                key = prefix + keyword
+                mag[key] = mag.get(key, 0) + 1
+                if positive:
+                    pos[key] = pos.get(key, 0) + 1
+        return self
+
+    def merge(self, other):
+        self.messages += other.messages
+        self.positives += other.positives
+        mag = self.mag
+        for key, count in other.mag.iteritems():
+            mag[key] = mag.get(key, 0) + count
+        pos = self.pos
+        for key, count in other.pos.iteritems():
+            pos[key] = pos.get(key, 0) + count
+        return self
+
+    def rows(self):
+        # (key, [mag, pos]) of every key, then (None, [messages, positives])
+        pos = self.pos
+        for key, count in self.mag.iteritems():
+            yield (key, [count, pos.get(key, 0)])
+        yield (None, [self.messages, self.positives])
+
+    def __reduce__(self):
+        keys = self.mag.keys()
+        mag = array.array('l', [self.mag[key] for key in keys])
+        pos = array.array('l', [self.pos.get(key, 0) for key in keys])
+        return (unpack_keyword_counts, (self.messages, self.positives, u'\x00'.join(keys).encode('utf-8'), mag.tostring(), pos.tostring()))
+
+    def __eq__(self, other):
+        return isinstance(other, KeywordCounts) and (self.messages, self.positives, self.mag, self.pos) == (other.messages, other.positives, other.mag, other.pos)
+
+    def __ne__(self, other):
+        return not self == other
 
 def build_agg(timespan, topN, kw = None):
     section_map = get_section_map()
@@ -740,10 +2548,106 @@ def build_aggs(timespan, top_5, kws, vals):
     for kw in kws:
         yield ((timespan, kw), build_agg(timespan, top_5, kw)(vals))
 
+def top_keywords(hourly_aggs, n=TIMESERIES_TOP_KEYWORDS):
+    # the `n` keywords of the most messages over all hours of a timespan,
+    # as ((section, keyword), count); the heap only ever holds `n` of them
+    sections = dict((prefix, section) for section, prefix in get_section_map().items())
+    totals = collections.defaultdict(int)
+    for agg in hourly_aggs:
+        for key, value in agg.iteritems():
+            totals[key] += value['mag']
+    top = heapq.nsmallest(n, totals.iteritems(), key=lambda item: (-item[1], item[0]))
+    return [((sections[key[:3]], key[3:]), count) for key, count in top]
+
+def build_timeseries(source, timespan, rows):
+    # the graph documents of a (source, timespan) from its hourly rows
+    # (hourLabel, key, [mag, pos]), as (path, document); the row with a
+    # `None` key counts all messages of the hour
+    hours = {}
+    messages = 0
+    for hourLabel, key, value in rows:
+        hour = hours.setdefault(hour_millis(hour_label_datetime(hourLabel)), {})
+        if key == None:
+            messages += int(value[0])
+        else:
+            hour[key] = { 'mag': int(value[0]), 'pos': int(value[1]) }
+    vals = sorted(hours.items())
+    kws = sorted(set(key for hour, agg in vals for key in agg))
+    top_5 = top_keywords(agg for hour, agg in vals)
+    documents = [('%s/%s/%s.json' % (source, key[0], key[1]), agg) for key, agg in build_aggs(timespan, top_5, kws, vals)]
+    return messages, documents
+
+def write_timeseries(data_source, container):
+    # write the graph documents of every (source, timespan) of a partition
+    # and return the number of messages and documents of each
+    def writer(groups):
+        summaries = []
+        def documents():
+            for (source, timespan), rows in groups:
+                messages, timespan_documents = build_timeseries(source, timespan, rows)
+                summaries.append((source, timespan, messages, len(timespan_documents)))
+                for document in timespan_documents:
+                    yield document
+        data_source.saveAllAsJson(documents(), container)
+        return summaries
+    return writer
+
+def hour_rows(kv):
+    # flatten the KeywordCounts of a (source, hour) into state records
+    (source, hourLabel), counts = kv
+    for key, value in counts.rows():
+        yield ((source, hourLabel, key), value)
+
+def merge_counts(a, b):
+    return [a[0] + b[0], a[1] + b[1]]
+
+def hourly_timeseries(messages):
+    # a single pass over the messages into hourly rows
+    # ((source, hourLabel, key), [mag, pos])
+    return messages.mapPartitions(timeseries_hour_keys) \
+        .combineByKey(KeywordCounts.of, KeywordCounts.add, KeywordCounts.merge) \
+        .flatMap(hour_rows)
+
+def timeseries_groups(timespans=None):
+    # key the hourly rows by every (source, timespan) graph they are part
+    # of, or only by those in `timespans`
+    def keyer(row):
+        (source, hourLabel, key), value = row
+        labels = build_timespan_labels(hour_label_datetime(hourLabel))
+        for timespanType in TIMESERIES_TIMESPAN_TYPES:
+            if timespans == None or labels[timespanType] in timespans:
+                yield ((source, labels[timespanType]), (hourLabel, key, value))
+    return keyer
+
+def aggregate_timeseries(hourly, data_source, container, timespans=None):
+    # bring the hours of each (source, timespan) together to build and
+    # write its graphs
+    return hourly.flatMap(timeseries_groups(timespans)).groupByKey() \
+        .mapPartitions(write_timeseries(data_source, container)).collect()
+
+def update_timeseries_state(sc, state, new_hourly, folder, retained=STATE_GENERATIONS):
+    # merge the hourly rows of a run's messages into the state and return
+    # the timespans they touch along with all hourly rows of those
+    # timespans, old and new
+    touched_days = set(state.partitions_of(new_hourly))
+    timespans = set(timespan for day in touched_days for timespan in timeseries_partition_timespans(day))
+    related_days = [day for day in state.manifest['partitions'] if set(timeseries_partition_timespans(day)) & timespans]
+    hourly = new_hourly.union(state.load(sc, related_days)).reduceByKey(merge_counts)
+    hourly.cache()
+    state.save(hourly.filter(lambda row: timeseries_partition_key(row[0]) in touched_days), folder)
+    state.commit(folder, retained)
+    return hourly, timespans
+
+def create_data_source(kind):
+    if kind == 'file':
+        return FileDataSource(getenv('FILE_COMPRESS', 'false') == 'true', getenv('FILE_MMAP', 'false') == 'true')
+    elif kind == 'blob':
+        return BlobSource()
+    raise ValueError('Unknown data source %s' % kind)
+
 def main(sc):
 
-    is_incremental = True
-    is_file_data_source = False
+    is_incremental = getenv('INCREMENTAL', 'true') != 'false'
     tile_path = getenv('TILE_INPUT_PATTERN')
     timeseries_path = getenv('TIMESERIES_INPUT_PATTERN')
 
@@ -752,160 +2656,255 @@ def main(sc):
     prevrdd_path = '/' + now
     mssgrdd_path = prevrdd_path
     nextrdd_path = '/associations/' + now
+    detailrdd_path = '/details/' + now
 
     input_container = getenv('INPUT_CONTAINER')
     tile_output_container = getenv('TILE_OUTPUT_CONTAINER')
     timeseries_output_container = getenv('TIMESERIES_OUTPUT_CONTAINER')
     message_container = getenv('MESSAGE_CONTAINER')
     tile_prev_container = getenv('TILE_PREV_CONTAINER')
+    tile_archive_container = getenv('TILE_ARCHIVE_CONTAINER', '')
+    # the hourly counts go to a container of their own, since the garbage
+    # collection of the state deletes every other folder of its container
+    timeseries_prev_container = getenv('TIMESERIES_PREV_CONTAINER', '') or timeseries_output_container.rstrip('/') + '-prev'
+    timeseries_rebuild = getenv('TIMESERIES_REBUILD', 'false') == 'true'
+    tile_pyramid_min_zoom = getenv('TILE_PYRAMID_MIN_ZOOM', '')
+    tile_pyramid_min_zoom = int(tile_pyramid_min_zoom) if tile_pyramid_min_zoom else None
+    skew_partitions = getenv('SKEW_PARTITIONS', '')
+    state_generations = getenv('STATE_GENERATIONS', STATE_GENERATIONS, int)
+    retention = RetentionPolicy.from_spec(getenv('STATE_RETENTION', DEFAULT_STATE_RETENTION), datetime.utcnow())
+
+    data_source = create_data_source(getenv('DATA_SOURCE', 'blob'))
+        
+    # the spans time the steps of the driver; since the RDDs are evaluated
+    # lazily, every span includes the stages its step is the first to need
+    with Stats(data_source, tile_output_container, sc, getenv('STATS_PROMETHEUS_FILE', '') or None) as stats:  
+        with stats.span('load_models'):
+            # get the list of keywords from Azure Table Storage
+            keywords = BroadcastModel(sc, 'keywords', get_keyword_terms(data_source), build_keyword_matchers)
+            
+            # get noisy keyword filters
+            keyword_filters = BroadcastModel(sc, 'keyword_filters', get_keyword_filter_terms(data_source), KeywordFilterIndex)
 
-    data_source = None
+            # get the language identification and sentiment models
+            language_classifier = BroadcastModel(sc, 'langid', { 'cache_size': getenv('LANGID_CACHE_SIZE', LANGID_CACHE_SIZE, int) }, LanguageClassifier.from_config)
+            scorer = BroadcastModel(sc, 'sentiment', load_sentiment_lines(data_source), SentimentScorer)
 
-    if is_file_data_source:
-        data_source = FileDataSource()
-    else:
-        print 'using azure'
-        data_source = BlobSource()
-        
-    with Stats(data_source, tile_output_container) as stats:  
-        # get the list of keywords from Azure Table Storage
-        keywords = get_keywords()
-        
-        # get noisy keyword filters
-        keyword_filters = get_keyword_filters()
+        stats.add_stat('model_versions', dict((model.name, model.version) for model in [keywords, keyword_filters, language_classifier, scorer]))
 
         # load the RDDs from storage
         lines = data_source.load(sc, input_container, tile_path)
 
-        # filter out lines without `Created` field
-        input_data = filter_to_valid(lines, stats, "tile")
-
-        # extract language from each line
-        input_data_lang = input_data.map(extract_langid)
-
-        # filter out noisy keywords
-        filtered_input_data = input_data_lang.filter(lambda x: filter_by_keywords(x, keyword_filters))
-
-        # compute sentiment for each line
-        scorer = load_sentiment_scorer(data_source)
-        input_data_sentiment = compute_sentiment(filtered_input_data, scorer)
-
-        # extract keywords from each line
-        input_data_keywords = input_data_sentiment.map(lambda x: extract_keywords(x, keywords)).filter(has_keywords)
+        # parse and validate each line, filter out noisy keywords, and
+        # extract language, sentiment, and keywords in a single pass
+        input_data_keywords = lines.mapPartitions(enrich_partition(
+            stats, "tile", keywords, keyword_filters, language_classifier, scorer,
+            getenv('LANGID_BATCH_SIZE', LANGID_BATCH_SIZE, int),
+            parse_message_fields(getenv('MESSAGE_FIELDS', ''))))
         input_data_keywords.cache()
 
         # dump lines with language, sentiment, and keywords
         projected_messages = input_data_keywords.map(normalize_message)
-        data_source.saveAsText(projected_messages, message_container, mssgrdd_path)
+        with stats.span('enrich_and_save_messages'):
+            data_source.saveAsText(projected_messages, message_container, mssgrdd_path)
+
+        # pick the keyword pairs to aggregate
+        pair_policy = KeywordPairPolicy.from_spec(getenv('KEYWORD_PAIRS', DEFAULT_KEYWORD_PAIRS))
 
         # map to keyword pairs, timespans, and tile IDs
-        segmented = input_data_keywords.flatMap(segment)
+        fanout = stats.histogram('pair_fanout', PAIR_FANOUT_BOUNDS)
+        segmented = input_data_keywords.mapPartitions(lambda sentences: segment_partition(sentences, fanout, pair_policy))
         segmented.cache()
 
         # filter out any errors
         valid_segmented = segmented.filter(lambda x: x[0] != 'TypeError' and x[0][0] != 'ValueError')
-        stats.add_stat('segment_errors', 
-                       segmented.filter(lambda x: x[0] == 'TypeError' or x[0][0] == 'ValueError').count())
+        with stats.span('segment'):
+            stats.add_stat('segment_errors', 
+                           segmented.filter(lambda x: x[0] == 'TypeError' or x[0][0] == 'ValueError').count())
         
-        # reduce on each keyword pair, timespan, and tile ID
-        reduced_segmented = valid_segmented.reduceByKey(merge_sentiment)
+        # in top mode, find the most frequent keyword pairs first; when their
+        # keys fit a broadcast, the other pairs are dropped before the
+        # shuffle, otherwise the reduced aggregates are matched up with them
+        unpruned_candidates = None
+        shuffled_segmented = valid_segmented
+        if pair_policy.mode == 'top':
+            max_broadcast_keys = getenv('PAIR_BROADCAST_MAX_KEYS', PAIR_BROADCAST_MAX_KEYS, int)
+            candidates = pair_candidates(valid_segmented, pair_policy.limit, pair_policy.capacity).cache()
+            with stats.span('top_pairs'):
+                top_pairs = PairKeySet.collect(candidates, max_broadcast_keys)
+            stats.add_stat('top_pairs_broadcast', len(top_pairs) if top_pairs != None else None)
+            if top_pairs != None:
+                top_pairs = sc.broadcast(top_pairs)
+                shuffled_segmented = valid_segmented.filter(lambda kv: top_pairs.value.keeps(kv))
+            else:
+                logger.warning('More than %d top keyword pairs, filtering them after the reduce', max_broadcast_keys)
+                unpruned_candidates = candidates
+
+        # pre-aggregate within each partition to cut the shuffle volume
+        combined_segmented = shuffled_segmented.mapPartitions(combine_partition(
+            getenv('COMBINER_MAX_KEYS', COMBINER_MAX_KEYS, int),
+            stats.counter('segment_records'),
+            stats.counter('combined_segment_records')))
+
+        # reduce on each keyword pair, timespan, and tile ID; in skew mode,
+        # on a partitioner that splits the keys heavy in a sample of the
+        # records, drawn from the pre-aggregated ones by the records they
+        # count; those are cached so that the sample does not run the
+        # combiner and its counters twice
+        partitioner = None
+        if skew_partitions:
+            combined_segmented.cache()
+            with stats.span('sample_skew'):
+                partitioner = SkewAwarePartitioner.from_sample(
+                    combined_segmented, combined_segmented.getNumPartitions() if skew_partitions == 'auto' else int(skew_partitions),
+                    getenv('SKEW_SAMPLE_FRACTION', SKEW_SAMPLE_FRACTION, float))
+            stats.add_stat('skewed_keys', len(partitioner.heavy))
+        elif unpruned_candidates != None:
+            # the top pairs are matched up with the aggregates on the
+            # partitioner of the reduce
+            partitioner = SkewAwarePartitioner(combined_segmented.getNumPartitions())
+        if partitioner != None:
+            reduced_segmented = reduce_skewed(combined_segmented, partitioner)
+        else:
+            reduced_segmented = combined_segmented.reduceByKey(merge_sentiment)
+
+        # keep only the most frequent keyword pairs of every source, timespan and tile
+        if unpruned_candidates != None:
+            reduced_segmented = filter_top_pairs(reduced_segmented, unpruned_candidates, partitioner)
 
         output_data = reduced_segmented
+
+        # roll the tiles up into their coarser zoom levels
+        if tile_pyramid_min_zoom != None:
+            with stats.span('rollup_pyramid'):
+                output_data = rollup_pyramid(output_data, tile_pyramid_min_zoom, getenv('COMBINER_MAX_KEYS', COMBINER_MAX_KEYS, int), partitioner)
         output_data.cache()
+        with stats.span('reduce'):
+            stats.add_stat('output_keys', output_data.count())
         
-        if not is_incremental:
-            # save RDDs for all data
-            data_source.saveAsText(output_data, tile_prev_container, prevrdd_path)
-            # remove 'keyword' discriminator from data
-            normalized = output_data.map(normalize_keys)
-            # save RDDs for new / updated data
-            data_source.saveAsText(normalized,  tile_output_container, nextrdd_path)
-
-        else:
-            loadrdd_path = '/*/part*'
-
-            # load previous data
-            prev_rdd = data_source.load(sc, tile_prev_container, loadrdd_path).flatMap(tuple_loader)
-            prev_rdd.cache()
+        state = tile_state_store(data_source, tile_prev_container)
 
-            # join previous data with new data and merge
-            merged_rdd = output_data.fullOuterJoin(prev_rdd).map(increment)
+        # keys past their retention stay in the output, but their state
+        # partitions are not kept, only archived
+        is_expired = lambda partition: retention.is_expired(state_partition_timespan(partition))
 
-            # TODO: filter out irrelevant keys (previous daily / hourly, out-of-date weeks, out-of-date months, etc.)
+        if not is_incremental:
+            # start the all-time state over from this run's data
+            with stats.span('save_state'):
+                state.reset()
+                pruned = state.save_retained(sc, output_data, prevrdd_path, is_expired, tile_archive_container)
+                state.commit(prevrdd_path, state_generations)
+            stats.add_stat('pruned_state_partitions', len(pruned))
+            outputs = output_data.map(output_values)
+            # save RDDs for new / updated data, without the 'keyword'
+            # discriminator and with tile ids
+            with stats.span('save_output'):
+                data_source.saveAsText(outputs.map(normalize_keys),  tile_output_container, nextrdd_path)
+                if tile_pyramid_min_zoom != None:
+                    data_source.saveAsText(tile_detail_maps(outputs), tile_output_container, detailrdd_path)
 
-            # save RDDs for all data
-            data_source.saveAsText(merged_rdd, tile_prev_container, prevrdd_path)
+        else:
+            if state.is_initialized():
+                # load only the state partitions this run has new keys for
+                with stats.span('partition_state'):
+                    touched_partitions = state.partitions_of(output_data)
+                prev_rdd = state.load(sc, touched_partitions)
+            elif state.is_outdated():
+                # state split by an earlier layout is loaded in full once
+                # and rewritten into the current partitions
+                prev_rdd = state.load(sc, list(state.manifest['partitions']))
+            else:
+                # state written before the manifest or the binary format
+                # existed is loaded in full once and rewritten into partitions
+                prev_rdd = state.load_legacy(sc, '/*/part*')
+
+            # co-group new and previous data once to get both the merged
+            # state and the new / updated keys
+            if partitioner != None:
+                # only the previous state is shuffled, onto the partitions of the new data
+                merged_state = cogroup_partitioned(output_data, prev_rdd, partitioner).map(merge_state)
+            else:
+                merged_state = output_data.cogroup(prev_rdd).map(merge_state)
+            merged_state.cache()
+
+            # save RDDs for all data of the touched partitions, and stop
+            # tracking the state partitions past their retention
+            merged_rdd = merged_state.map(lambda x: (x[0], x[1]))
+            with stats.span('merge_and_save_state'):
+                pruned = state.save_retained(sc, merged_rdd, prevrdd_path, is_expired, tile_archive_container)
+            stats.add_stat('pruned_state_partitions', len(pruned))
 
-            # compute new / updated data with left outer join
-            new_rdd = output_data.leftOuterJoin(prev_rdd).map(increment)
             # save RDDs for new / updated data
-            data_source.saveAsText(new_rdd, tile_output_container, nextrdd_path)
-
-            # delete previous load folders from previous container
-            # rather than deleting these, we should periodically back these up
-            # if a run gets botched in the middle of processing, we probably
-            # do not want to re-run all data for all time
-            data_source.deleteAllBut(tile_prev_container, now)
+            new_rdd = merged_state.filter(lambda x: x[2]).map(lambda x: output_values((x[0], x[1])))
+            with stats.span('save_output'):
+                data_source.saveAsText(new_rdd.map(normalize_keys), tile_output_container, nextrdd_path)
+                if tile_pyramid_min_zoom != None:
+                    data_source.saveAsText(tile_detail_maps(new_rdd), tile_output_container, detailrdd_path)
+
+            # switch the state over to this run's generation
+            with stats.span('commit_state'):
+                state.commit(prevrdd_path, state_generations)
+
+        # delete the files no retained generation refers to anymore
+        stats.add_stat('state_generation', state.manifest.get('generation') if state.is_initialized() else None)
+        garbage_collection = state.delete_unreferenced_async()
             
-#        # read all messages
-#        messages_lines = data_source.load(sc, message_container, timeseries_path)
-#        all_messages = filter_to_valid(messages_lines, stats, "timeseries")
-#        all_messages.cache()
-#        
-#        # get distinct sources
-#        sources = all_messages.flatMap(get_sources).distinct().collect()
-#        for source in sources:
-#            # filter for single source
-#            source_filtered = all_messages.filter(matches_source(source))
-#            # get distinct timespaces
-#            timespans = source_filtered.flatMap(get_timespans).distinct().collect()
-#            recs_by_timespan = {}
-#            for timespan in timespans:
-#                # filter for single timespan
-#                filtered = source_filtered.filter(matches_timespan(timespan))
-#                filtered.cache()
-#                
-#                recs_by_timespan[timespan] = filtered.count()
-#                
-#                # flat map all keywords
-#                sectioned = filtered.flatMap(split_keywords)
-#                # count keywords
-#                by_key = sectioned.reduceByKey(lambda a,b: a + b)
-#                # take top 5 keyword counts
-#                top_5 = by_key.takeOrdered(5, key=lambda x: -x[1])
-#
-#                # flat my messages by hour
-#                filtered_by_hour = filtered.flatMap(by_hour)
-#
-#                # count message keywords by hour
-#                hourly_counts = filtered_by_hour.combineByKey(create_agg_all(merge_sentence_all), merge_sentence_all, merge_agg)
-#                # sort aggregated counts by hour
-#                ordered_counts = hourly_counts.sortByKey().groupBy(lambda x: timespan)
-#                # get distinct hour keys
-#                all_keys = hourly_counts.flatMap(lambda x: x[1].keys()).distinct().collect()
-#                # build hourly aggregation graph
-#                all_kw_groups = ordered_counts.flatMap(lambda x: build_aggs(x[0], top_5, all_keys, x[1]))
-#                # write data to blob storage
-#                all_kw_groups.foreach(lambda x: data_source.saveAsJson(x[1], timeseries_output_container, '%s/%s/%s.json' % (source, x[0][0], x[0][1])))
-#            stats.add_stat(source + '_records_by_timespan', recs_by_timespan)
+        # aggregate the messages into the timeseries graphs; an incremental
+        # run only adds its own messages to the hourly counts and rebuilds
+        # the graphs of the timespans they fall into, while a bootstrap run,
+        # a run without hourly counts yet or TIMESERIES_REBUILD recounts all
+        # the messages
+        timespans = None
+        with stats.span('timeseries'):
+            timeseries_state = PartitionedStateStore(data_source, timeseries_prev_container, timeseries_partition_key, value_decoder=list,
+                                                     max_files=getenv('STATE_MAX_FILES', STATE_MAX_FILES, int))
+            if is_incremental and not timeseries_rebuild and timeseries_state.is_initialized():
+                hourly, timespans = update_timeseries_state(sc, timeseries_state, hourly_timeseries(input_data_keywords), prevrdd_path, state_generations)
+            else:
+                messages_lines = data_source.load(sc, message_container, timeseries_path)
+                hourly = hourly_timeseries(filter_to_valid(messages_lines, stats, "timeseries")).cache()
+                timeseries_state.reset()
+                timeseries_state.save(hourly, prevrdd_path)
+                timeseries_state.commit(prevrdd_path, state_generations)
+            stats.add_stat('timeseries_rebuilt', timespans == None)
+            summaries = aggregate_timeseries(hourly, data_source, timeseries_output_container, timespans)
+        for source, timespan, messages, documents in summaries:
+            stats.payload.setdefault(source + '_records_by_timespan', {})[timespan] = messages
+        stats.add_stat('timeseries_documents', sum(documents for source, timespan, messages, documents in summaries))
+        timeseries_collection = timeseries_state.delete_unreferenced_async()
+
+        with stats.span('garbage_collection_wait'):
+            garbage_collection.join()
+            timeseries_collection.join()
+
+JOB_ARGUMENTS = ['STORAGE_ACCOUNT', 'STORAGE_KEY', 'INPUT_CONTAINER', 'TILE_INPUT_PATTERN', 'TILE_PREV_CONTAINER',
+                 'TILE_OUTPUT_CONTAINER', 'MESSAGE_CONTAINER', 'TIMESERIES_INPUT_PATTERN', 'TIMESERIES_OUTPUT_CONTAINER',
+                 'KEYWORD_TABLE_NAME', 'FILTER_TABLE_NAME', 'SENTIMENT_CONTAINER', 'SENTIMENT_MODEL']
+
+def parse_job_arguments(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Aggregates the messages of a day by keyword, timespan and tile.')
+    # Keep in sync with 
+    for name in JOB_ARGUMENTS:
+        parser.add_argument(name.lower())
+    parser.add_argument('--data-source', choices=['blob', 'file'], default='blob',
+                        help='read and write Azure storage, or local folders for the containers and json lines files for the tables')
+    parser.add_argument('--bootstrap', action='store_true', help='start the state over instead of merging into it')
+    parser.add_argument('--compress', action='store_true', help='gzip the text output of the file data source')
+    parser.add_argument('--mmap', action='store_true', help='memory map the files read by the file data source')
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
+    import sys
+    args = parse_job_arguments(sys.argv[1:])
+    for name in JOB_ARGUMENTS:
+        os.environ[name] = str(getattr(args, name.lower()))
+    os.environ['DATA_SOURCE'] = args.data_source
+    os.environ['INCREMENTAL'] = 'false' if args.bootstrap else 'true'
+    os.environ['FILE_COMPRESS'] = 'true' if args.compress else 'false'
+    os.environ['FILE_MMAP'] = 'true' if args.mmap else 'false'
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     conf = SparkConf()
     sc = SparkContext(conf=conf)
-    import sys
-    # Keep in sync with 
-    os.environ['STORAGE_ACCOUNT'] = str(sys.argv[1])
-    os.environ['STORAGE_KEY'] = str(sys.argv[2])
-    os.environ['INPUT_CONTAINER'] = str(sys.argv[3])
-    os.environ['TILE_INPUT_PATTERN'] = str(sys.argv[4])
-    os.environ['TILE_PREV_CONTAINER'] = str(sys.argv[5])
-    os.environ['TILE_OUTPUT_CONTAINER'] = str(sys.argv[6])
-    os.environ['MESSAGE_CONTAINER'] = str(sys.argv[7])
-    os.environ['TIMESERIES_INPUT_PATTERN'] = str(sys.argv[8])
-    os.environ['TIMESERIES_OUTPUT_CONTAINER'] = str(sys.argv[9])
-    os.environ['KEYWORD_TABLE_NAME'] = str(sys.argv[10])
-    os.environ['FILTER_TABLE_NAME'] = str(sys.argv[11])
-    os.environ['SENTIMENT_CONTAINER'] = str(sys.argv[12])
-    os.environ['SENTIMENT_MODEL'] = str(sys.argv[13])
     main(sc)
 
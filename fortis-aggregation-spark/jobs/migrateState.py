@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Rewrites the `repr` text state of a prev container, or binary state split by
+an earlier layout, into the current binary state partitions.
+
+Submit together with the byTile job script:
+    spark-submit --py-files bytileAggregator.py migrateState.py <storage account> <storage key> <prev container>
+"""
+
+from pyspark import SparkConf, SparkContext
+from datetime import datetime
+import logging
+import os
+import sys
+import time
+
+from bytileAggregator import BlobSource, migrate_state
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    conf = SparkConf()
+    sc = SparkContext(conf=conf)
+    os.environ['STORAGE_ACCOUNT'] = str(sys.argv[1])
+    os.environ['STORAGE_KEY'] = str(sys.argv[2])
+    container = str(sys.argv[3])
+    now = datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+    migrate_state(sc, BlobSource(), container, '/' + now)
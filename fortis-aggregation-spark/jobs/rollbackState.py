@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""
+Points the state of a prev container back at an earlier generation.
+
+Submit together with the byTile job script:
+    spark-submit --py-files bytileAggregator.py rollbackState.py <storage account> <storage key> <prev container> <generation>
+"""
+
+import logging
+import os
+import sys
+
+from bytileAggregator import BlobSource, rollback_state
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    os.environ['STORAGE_ACCOUNT'] = str(sys.argv[1])
+    os.environ['STORAGE_KEY'] = str(sys.argv[2])
+    container = str(sys.argv[3])
+    generation = str(sys.argv[4])
+    rollback_state(BlobSource(), container, generation)
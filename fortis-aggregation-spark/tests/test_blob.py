@@ -0,0 +1,118 @@
+import itertools
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+from azure.common import AzureMissingResourceHttpError
+
+class FakeService(object):
+    # in-memory stand-in for a blob service, shared by the threads of a pool
+    def __init__(self, failures=0, delay=0.0):
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.failures = failures
+        self.delay = delay
+        self.attempts = 0
+        self.running = 0
+        self.max_running = 0
+        self.threads = set()
+
+    def factory(self):
+        with self.lock:
+            self.threads.add(threading.current_thread().ident)
+        return self
+
+    def put_blob(self, container, name, data):
+        with self.lock:
+            self.attempts += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            fail = self.failures > 0
+            if fail:
+                self.failures -= 1
+        try:
+            time.sleep(self.delay)
+            if fail:
+                raise IOError('transient')
+            with self.lock:
+                self.blobs[(container, name)] = data
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def delete_blob(self, container, name):
+        with self.lock:
+            self.attempts += 1
+            if (container, name) not in self.blobs:
+                raise AzureMissingResourceHttpError('missing', 404)
+            del self.blobs[(container, name)]
+
+def pool(service, workers=4, max_in_flight=8, retries=3):
+    return job.BlobPool(service.factory, workers, max_in_flight, retries, backoff=0.0)
+
+def put(service, name):
+    service.put_blob('c', name, 'data')
+
+class BlobPoolTest(unittest.TestCase):
+
+    def test_call_retries_transient_errors(self):
+        service = FakeService(failures=2)
+        pool(service).call(lambda service: put(service, 'a'))
+        self.assertEqual(service.attempts, 3)
+        self.assertEqual(service.blobs, {('c', 'a'): 'data'})
+
+    def test_call_gives_up_after_the_retries(self):
+        service = FakeService(failures=10)
+        self.assertRaises(IOError, pool(service, retries=2).call, lambda service: put(service, 'a'))
+        self.assertEqual(service.attempts, 3)
+
+    def test_missing_blobs_are_not_retried(self):
+        service = FakeService()
+        self.assertRaises(AzureMissingResourceHttpError, pool(service).call, lambda service: service.delete_blob('c', 'a'))
+        self.assertEqual(service.attempts, 1)
+
+    def test_run_requests_every_item_on_the_workers(self):
+        service = FakeService(failures=5, delay=0.001)
+        names = ['blob%d' % i for i in range(100)]
+        self.assertEqual(pool(service).run(put, iter(names)), 100)
+        self.assertEqual(sorted(name for container, name in service.blobs), sorted(names))
+        # every worker thread creates its service once
+        self.assertTrue(len(service.threads) <= 4)
+
+    def test_run_bounds_the_requests_in_flight(self):
+        service = FakeService(delay=0.002)
+        submitted = []
+        lock = threading.Lock()
+        def items():
+            for i in range(60):
+                with lock:
+                    in_flight = len(submitted) - len(service.blobs)
+                self.assertTrue(in_flight <= 3, in_flight)
+                submitted.append(i)
+                yield 'blob%d' % i
+        self.assertEqual(pool(service, workers=2, max_in_flight=3).run(put, items()), 60)
+        self.assertTrue(service.max_running <= 2)
+
+    def test_run_stops_after_an_error(self):
+        service = FakeService()
+        def request(service, item):
+            if item == 5:
+                raise IOError('down')
+            put(service, str(item))
+        # the items never end, the failure stops the run
+        self.assertRaises(IOError, pool(service, workers=2, max_in_flight=4, retries=0).run, request, itertools.count())
+        self.assertTrue(len(service.blobs) < 5 + 4)
+
+    def test_ignore_missing(self):
+        service = FakeService()
+        service.blobs[('c', 'b')] = 'data'
+        deleted = pool(service).run(job.ignore_missing(lambda service, name: service.delete_blob('c', name)), ['a', 'b', 'c'])
+        self.assertEqual(deleted, 3)
+        self.assertEqual(service.blobs, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+class FastJsonTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        message = {'MessageId': 'x', 'Sentence': u'مطر today', 'Keywords': [u'rain'], 'Sentiment': 0.25, 'Count': 3}
+        self.assertEqual(job.fast_loads(job.fast_dumps(message)), message)
+
+    def test_integers_beyond_64_bits_fall_back_to_json(self):
+        message = {'MessageId': 'x', 'Id': 2 ** 70, 'Negative': -2 ** 65}
+        line = json.dumps(message)
+        self.assertEqual(job.fast_loads(line), message)
+        self.assertEqual(json.loads(job.fast_dumps(message)), message)
+
+if __name__ == '__main__':
+    unittest.main()
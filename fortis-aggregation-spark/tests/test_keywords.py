@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+KEYWORDS = {
+    u'rain': u'rain',
+    u'new york': u'New York',
+    u'new-york': u'new-york',
+    u'covid_19': u'covid_19',
+    u'g20': u'G20',
+    u'2016': u'2016',
+    u'مطر': u'مطر',
+    u'الأمم المتحدة': u'الأمم المتحدة',
+    u'u.s.': u'U.S.',
+}
+
+SENTENCES = [
+    u'heavy rain today',
+    u'Heavy RAIN today',
+    u'rain, then sun',
+    u'(rain)',
+    u'rain.',
+    u'rainfall and raining',
+    u'new york',
+    u'NEW\tYORK',
+    u'new\nyork',
+    u'new \t\n york',
+    u'newyork',
+    u'new-york',
+    u'New-York city',
+    u'new - york',
+    u'new york-based',
+    u'covid_19 cases',
+    u'covid 19 cases',
+    u'covid_19_cases',
+    u'G20 summit',
+    u'g20s',
+    u'in 2016, then 20160',
+    u'مطر غزير',
+    u'المطر',
+    u'الأمم المتحدة',
+    u'الأمم\tالمتحدة!',
+    u'الأممالمتحدة',
+    u'the U.S. and the us',
+    u'',
+]
+
+def regex_matches(phrases, text):
+    # the one regex per phrase the matcher replaced
+    return set(phrase_id for phrase_id, phrase in phrases.items() if job.create_keyword_regex(phrase).search(text))
+
+class PhraseMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = job.PhraseMatcher(KEYWORDS)
+
+    def assertMatches(self, text, expected):
+        self.assertEqual(self.matcher.matches(text), set(expected))
+
+    def test_same_matches_as_the_regexes(self):
+        for text in SENTENCES:
+            self.assertEqual(self.matcher.matches(text), regex_matches(KEYWORDS, text), text)
+
+    def test_whitespace_between_phrase_tokens(self):
+        self.assertMatches(u'new\tyork', [u'new york'])
+        self.assertMatches(u'new\nyork', [u'new york'])
+        self.assertMatches(u'new \t\n york', [u'new york'])
+        self.assertMatches(u'newyork', [])
+
+    def test_punctuation_next_to_a_phrase(self):
+        self.assertMatches(u'rain, then sun', [u'rain'])
+        self.assertMatches(u'(rain)', [u'rain'])
+        self.assertMatches(u'rainfall', [])
+
+    def test_underscores_and_digits_are_word_characters(self):
+        self.assertMatches(u'covid_19 cases', [u'covid_19'])
+        self.assertMatches(u'covid 19 cases', [])
+        self.assertMatches(u'covid_19_cases', [])
+        self.assertMatches(u'G20 summit', [u'g20'])
+        self.assertMatches(u'g20s', [])
+        self.assertMatches(u'in 2016, then 20160', [u'2016'])
+
+    def test_hyphenated_text(self):
+        # the tokens of a keyword are joined by whitespace, even around punctuation
+        self.assertMatches(u'New-York city', [])
+        self.assertMatches(u'new - york', [u'new-york'])
+        self.assertMatches(u'new york-based', [u'new york'])
+
+    def test_arabic_and_mixed_case(self):
+        self.assertMatches(u'Heavy RAIN today', [u'rain'])
+        self.assertMatches(u'NEW\tYORK', [u'new york'])
+        self.assertMatches(u'مطر غزير', [u'مطر'])
+        self.assertMatches(u'المطر', [])
+        self.assertMatches(u'الأمم\tالمتحدة!', [u'الأمم المتحدة'])
+        self.assertMatches(u'الأممالمتحدة', [])
+
+    def test_phrases_with_punctuation_keep_their_regex(self):
+        self.assertEqual(sorted(phrase_id for phrase_id, regex in self.matcher.regexes), [u'new-york', u'u.s.'])
+
+class KeywordFilterIndexTest(unittest.TestCase):
+
+    FILTERS = [[u'rain', u'new york'], [u'g20'], [u'مطر', u'covid_19']]
+
+    def filtered_by_regexes(self, text):
+        return any(all(job.create_keyword_regex(term).search(text) for term in conjunction) for conjunction in self.FILTERS)
+
+    def test_same_matches_as_the_regexes(self):
+        index = job.KeywordFilterIndex(self.FILTERS)
+        for text in SENTENCES + [u'rain in new\tyork', u'covid_19 and مطر', u'covid 19 and مطر']:
+            self.assertEqual(index.matches(text), self.filtered_by_regexes(text), text)
+
+    def test_every_term_of_a_filter_must_match(self):
+        index = job.KeywordFilterIndex(self.FILTERS)
+        self.assertTrue(index.matches(u'Rain over\nNew York'))
+        self.assertFalse(index.matches(u'rain over new-york'))
+        self.assertFalse(index.matches(u'مطر'))
+        self.assertTrue(index.matches(u'مطر, covid_19'))
+
+    def test_a_filter_without_terms_matches_everything(self):
+        self.assertTrue(job.KeywordFilterIndex([[u'rain'], []]).matches(u'sunny'))
+        self.assertFalse(job.KeywordFilterIndex([]).matches(u'sunny'))
+
+if __name__ == '__main__':
+    unittest.main()
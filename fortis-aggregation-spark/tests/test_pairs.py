@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import collections
+import cPickle
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+def summarize(items, capacity):
+    summary = job.PairSummary(capacity)
+    for item in items:
+        summary.add(item)
+    return summary
+
+class PairSummaryTest(unittest.TestCase):
+
+    def test_exact_below_capacity(self):
+        summary = summarize('abcabca', 3)
+        self.assertEqual(summary.counts, {'a': 3, 'b': 2, 'c': 2})
+        self.assertEqual(summary.top(2), [('a', 3), ('b', 2)])
+
+    def test_weighted_adds(self):
+        summary = job.PairSummary(2)
+        summary.add('a', 5)
+        summary.add('b', 2)
+        summary.add('c', 3)
+        # every counter and `c` lose the smallest count, the 2 of `b`
+        self.assertEqual(summary.counts, {'a': 3, 'c': 1})
+
+    def test_merge_keeps_the_frequent_pairs(self):
+        rng = random.Random(3)
+        stream = [rng.choice('abcdefghij') if rng.random() < 0.5 else str(rng.randint(0, 1000)) for _ in range(20000)]
+        capacity = 50
+        merged = reduce(job.PairSummary.merge, [summarize(stream[i::4], capacity) for i in range(4)])
+        self.assertTrue(len(merged.counts) <= capacity)
+        # every item seen more than n / (capacity + 1) times keeps a counter
+        # that undercounts it by at most that much
+        bound = len(stream) / float(capacity + 1)
+        for item, count in collections.Counter(stream).items():
+            if count > bound:
+                self.assertTrue(count - bound <= merged.counts.get(item, 0) <= count, item)
+        self.assertEqual(sorted(item for item, count in merged.top(10)), list('abcdefghij'))
+
+    def test_merge_below_capacity_adds_up(self):
+        merged = summarize('aab', 10).merge(summarize('bc', 10))
+        self.assertEqual(merged.counts, {'a': 2, 'b': 2, 'c': 1})
+
+class KeywordPairPolicyTest(unittest.TestCase):
+
+    KEYWORDS = sorted('abcdefgh')
+
+    def test_from_spec(self):
+        self.assertEqual(job.KeywordPairPolicy.from_spec('').mode, 'all')
+        top = job.KeywordPairPolicy.from_spec('top:5')
+        self.assertEqual((top.mode, top.limit, top.capacity), ('top', 5, job.PAIR_SUMMARY_FACTOR * 5))
+        self.assertEqual(job.KeywordPairPolicy.from_spec('top:5:30').capacity, 30)
+        self.assertRaises(ValueError, job.KeywordPairPolicy.from_spec, 'most:5')
+
+    def test_all_and_top_emit_every_pair(self):
+        for spec in ['all', 'top:2']:
+            pairs = job.KeywordPairPolicy.from_spec(spec).message_pairs({'MessageId': 'x'}, self.KEYWORDS)
+            self.assertEqual(len(pairs), 28)
+
+    def test_cap_samples_the_same_pairs_on_every_run(self):
+        policy = job.KeywordPairPolicy.from_spec('cap:5')
+        pairs = policy.message_pairs({'MessageId': 'x'}, self.KEYWORDS)
+        self.assertEqual(len(pairs), 5)
+        self.assertEqual(pairs, policy.message_pairs({'MessageId': 'x'}, self.KEYWORDS))
+        self.assertTrue(all(first < second for first, second in pairs))
+
+class Candidates(object):
+    # the part of the RDD api `PairKeySet.collect` uses, over a list of keys
+    def __init__(self, keys):
+        self.keys = keys
+
+    def map(self, f):
+        return Candidates([f(key) for key in self.keys])
+
+    def take(self, n):
+        return self.keys[:n]
+
+def pair_key(first, second, tileKey=1):
+    return ('keyword', 'twitter', first, second, 'alltime', tileKey)
+
+class PairKeySetTest(unittest.TestCase):
+
+    CANDIDATES = [pair_key(u'a', u'b'), pair_key(u'a', u'c'), pair_key(u'مطر', u'rain', 2)]
+
+    def test_keeps_single_keywords_and_candidates(self):
+        keys = job.PairKeySet.collect(Candidates(self.CANDIDATES))
+        self.assertEqual(len(keys), 3)
+        for key in self.CANDIDATES:
+            self.assertTrue(keys.keeps((key, None)))
+        self.assertFalse(keys.keeps((pair_key(u'b', u'c'), None)))
+        self.assertFalse(keys.keeps((pair_key(u'a', u'b', 2), None)))
+        self.assertTrue(keys.keeps((pair_key(u'z', None), None)))
+
+    def test_pickles_as_packed_hashes(self):
+        keys = cPickle.loads(cPickle.dumps(job.PairKeySet.collect(Candidates(self.CANDIDATES)), 2))
+        self.assertEqual([key in keys for key in self.CANDIDATES + [pair_key(u'b', u'c')]], [True, True, True, False])
+
+    def test_too_many_candidates_are_not_collected(self):
+        self.assertEqual(job.PairKeySet.collect(Candidates(self.CANDIDATES), 2), None)
+        self.assertEqual(len(job.PairKeySet.collect(Candidates(self.CANDIDATES), 3)), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+class Partitions(object):
+    # the part of the RDD api `from_sample` uses, over lists of records
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+    def mapPartitionsWithIndex(self, f):
+        return Partitions([list(f(index, iter(records))) for index, records in enumerate(self.partitions)])
+
+    def reduceByKey(self, f):
+        reduced = {}
+        for records in self.partitions:
+            for key, value in records:
+                reduced[key] = f(reduced[key], value) if key in reduced else value
+        return Partitions([reduced.items()])
+
+    def collectAsMap(self):
+        return dict(record for records in self.partitions for record in records)
+
+HOT = ('keyword', 'twitter', u'rain', None, 'alltime', 1)
+WARM = ('keyword', 'twitter', u'sun', None, 'alltime', 1)
+
+def records(key, count):
+    return [(key, job.SentimentAccumulator.of(0.5)) for _ in range(count)]
+
+def tail(count, keys):
+    return [(('keyword', 'twitter', u'k%d' % (i % keys), None, 'alltime', 1), job.SentimentAccumulator.of(0.5)) for i in range(count)]
+
+def combined(raw, numPartitions, max_keys=job.COMBINER_MAX_KEYS):
+    # the raw records dealt round robin over the partitions, pre-aggregated
+    # the way `main` does before sampling
+    random.Random(1).shuffle(raw)
+    combiner = job.combine_partition(max_keys)
+    return Partitions([list(combiner(iter(raw[i::numPartitions]))) for i in range(numPartitions)])
+
+class SkewAwarePartitionerTest(unittest.TestCase):
+
+    def test_from_sample_splits_the_heavy_keys(self):
+        partitions = combined(records(HOT, 300) + records(WARM, 150) + tail(100, 100), 5)
+        # pre-aggregation leaves a single record per key and partition
+        self.assertEqual(sum(1 for records in partitions.partitions for key, value in records if key == HOT), 5)
+        partitioner = job.SkewAwarePartitioner.from_sample(partitions, 5, 1.0)
+        # a partition's average is 110 sampled records
+        self.assertEqual(partitioner.numPartitions, 5)
+        self.assertEqual(partitioner.heavy, {HOT: (0, 3), WARM: (2, 2)})
+
+    def test_from_sample_finds_a_heavy_key_behind_the_combiner(self):
+        # one key holds 30% of 160k records, spread over 8 partitions
+        partitions = combined(records(HOT, 48000) + tail(112000, 20000), 8)
+        partitioner = job.SkewAwarePartitioner.from_sample(partitions, 8)
+        self.assertEqual(partitioner.heavy.keys(), [HOT])
+        self.assertEqual(partitioner.heavy[HOT][1], 3)
+
+    def test_from_sample_counts_the_records_of_every_flush(self):
+        partitions = combined(records(HOT, 3000) + tail(3000, 1000), 4, max_keys=50)
+        self.assertTrue(sum(1 for records in partitions.partitions for key, value in records if key == HOT) > 4)
+        self.assertEqual(job.SkewAwarePartitioner.from_sample(partitions, 4, 0.5).heavy.keys(), [HOT])
+
+    def test_from_sample_without_skew(self):
+        self.assertEqual(job.SkewAwarePartitioner.from_sample(combined(tail(50000, 500), 4), 4).heavy, {})
+        # a few sampled records are not enough to call a key heavy
+        self.assertEqual(job.SkewAwarePartitioner.from_sample(combined(records(HOT, 5), 4), 4, 1.0).heavy, {})
+
+    def test_places_keys(self):
+        partitioner = job.SkewAwarePartitioner(8, {HOT: (4, 3)})
+        self.assertEqual(partitioner(WARM), job.portable_hash(WARM))
+        self.assertEqual(partitioner(HOT), 4)
+        self.assertEqual([partitioner((job.SALTED_KEY, HOT, split)) for split in range(3)], [4, 5, 6])
+
+    def test_salt_spreads_heavy_keys_round_robin(self):
+        partitioner = job.SkewAwarePartitioner(8, {HOT: (4, 3)})
+        salted = list(partitioner.salt(1, iter(records(HOT, 4) + records(WARM, 2))))
+        self.assertEqual([key for key, value in salted],
+                         [(job.SALTED_KEY, HOT, 1), (job.SALTED_KEY, HOT, 2), (job.SALTED_KEY, HOT, 0), (job.SALTED_KEY, HOT, 1), WARM, WARM])
+        # partitions start the round robin at different splits
+        self.assertEqual(next(partitioner.salt(2, iter(records(HOT, 1))))[0], (job.SALTED_KEY, HOT, 2))
+
+    def test_salt_without_heavy_keys_passes_records_through(self):
+        original = records(HOT, 3)
+        self.assertEqual(list(job.SkewAwarePartitioner(8).salt(0, iter(original))), original)
+
+    def test_equality(self):
+        partitioner = job.SkewAwarePartitioner(8, {HOT: (4, 3)})
+        same = job.SkewAwarePartitioner(8, {HOT: (4, 3)})
+        self.assertEqual(partitioner, same)
+        self.assertEqual(hash(partitioner), hash(same))
+        self.assertNotEqual(partitioner, job.SkewAwarePartitioner(8))
+        self.assertNotEqual(partitioner, job.SkewAwarePartitioner(16, {HOT: (4, 3)}))
+        self.assertNotEqual(partitioner, 8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+class TimespanLabelEndTest(unittest.TestCase):
+
+    def test_hour_day_month_year(self):
+        self.assertEqual(job.timespan_label_end('hour-2016-05-01-23:00'), datetime(2016, 5, 2))
+        self.assertEqual(job.timespan_label_end('day-2016-02-29'), datetime(2016, 3, 1))
+        self.assertEqual(job.timespan_label_end('month-2016-12'), datetime(2017, 1, 1))
+        self.assertEqual(job.timespan_label_end('year-2016'), datetime(2017, 1, 1))
+        self.assertEqual(job.timespan_label_end('alltime'), None)
+
+    def test_groups_of_hours_and_days(self):
+        self.assertEqual(job.timespan_label_end('hour-2016-05-31'), datetime(2016, 6, 1))
+        self.assertEqual(job.timespan_label_end('day-2016-02'), datetime(2016, 3, 1))
+        self.assertEqual(job.timespan_label_end('day-2016-12'), datetime(2017, 1, 1))
+
+    def test_weeks_at_the_turn_of_the_year(self):
+        # January 1st to 3rd 2016 are in ISO week 53 of 2015
+        self.assertEqual(job.timespan_label_end('week-2016-53'), datetime(2016, 1, 4))
+        self.assertEqual(job.timespan_label_end('week-2015-53'), datetime(2016, 1, 1))
+        # December 31st 2018 is in ISO week 1 of 2019
+        self.assertEqual(job.timespan_label_end('week-2018-01'), datetime(2019, 1, 1))
+        self.assertEqual(job.timespan_label_end('week-2017-01'), datetime(2017, 1, 9))
+        # January 1st 2017 is in ISO week 52 of 2016
+        self.assertEqual(job.timespan_label_end('week-2017-52'), datetime(2018, 1, 1))
+        self.assertEqual(job.timespan_label_end('week-2016-52'), datetime(2017, 1, 1))
+
+    def test_weeks_end_with_their_last_day(self):
+        last_days = {}
+        day = datetime(2014, 1, 1)
+        while day < datetime(2022, 1, 1):
+            last_days[job.build_timespan_label('week', day)] = day
+            day += timedelta(days=1)
+        for label, last_day in last_days.items():
+            self.assertEqual(job.timespan_label_end(label), last_day + timedelta(days=1), label)
+
+class RetentionPolicyTest(unittest.TestCase):
+
+    NOW = datetime(2016, 5, 10, 12)
+
+    def test_from_spec(self):
+        policy = job.RetentionPolicy.from_spec(' hour=48h, day=90d,week=26w ', self.NOW)
+        self.assertEqual(policy.retention, {'hour': timedelta(hours=48), 'day': timedelta(days=90), 'week': timedelta(weeks=26)})
+        self.assertEqual(job.RetentionPolicy.from_spec('', self.NOW).retention, {})
+
+    def test_from_spec_rejects_timespans_without_an_end(self):
+        self.assertRaises(ValueError, job.RetentionPolicy.from_spec, 'alltime=1d', self.NOW)
+        self.assertRaises(ValueError, job.RetentionPolicy.from_spec, 'minute=1h', self.NOW)
+
+    def test_is_expired(self):
+        policy = job.RetentionPolicy.from_spec('hour=48h,day=1d', self.NOW)
+        # the hour ends at 2016-05-08 12:00, exactly 48 hours ago
+        self.assertFalse(policy.is_expired('hour-2016-05-08-11:00'))
+        self.assertTrue(policy.is_expired('hour-2016-05-08-10:00'))
+        self.assertFalse(policy.is_expired('day-2016-05-09'))
+        self.assertTrue(policy.is_expired('day-2016-05-08'))
+        # a group of hours expires with its last hour
+        self.assertFalse(policy.is_expired('hour-2016-05-08'))
+        self.assertTrue(policy.is_expired('hour-2016-05-07'))
+
+    def test_types_without_retention_are_kept(self):
+        policy = job.RetentionPolicy.from_spec('hour=1h', self.NOW)
+        for label in ['day-2010-01-01', 'week-2010-01', 'month-2010-01', 'year-2010', 'alltime']:
+            self.assertFalse(policy.is_expired(label), label)
+        self.assertFalse(any(job.RetentionPolicy.from_spec(job.DEFAULT_STATE_RETENTION, self.NOW).is_expired(label)
+                             for label in ['hour-2010-01-01-00:00', 'day-2010-01-01']))
+
+    def test_keeps(self):
+        policy = job.RetentionPolicy.from_spec('day=1d', self.NOW)
+        self.assertTrue(policy.keeps((('keyword', 'twitter', u'rain', None, 'day-2016-05-09', 1), [1.0, 0.5])))
+        self.assertFalse(policy.keeps((('keyword', 'twitter', u'rain', None, 'day-2016-05-01', 1), [1.0, 0.5])))
+
+if __name__ == '__main__':
+    unittest.main()
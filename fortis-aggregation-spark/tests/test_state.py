@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+def decode_all(blocks):
+    return [record for block in blocks for record in job.StateCodec.decode_block(block)]
+
+class StateCodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        tileKey = job.Tile.tile_key_from_tile_id('15_23000_15000')
+        records = [
+            (('keyword', 'twitter', u'rain', None, 'day-2016-05-01', tileKey), [3.0, 0.25]),
+            (('keyword', 'twitter', u'rain', u'مطر', 'alltime', tileKey), [1.0, 0.5]),
+            (('keyword', 'facebook-messages', u'new york', None, 'alltime', tileKey + 1), [2.0, 1.0 / 3]),
+        ]
+        decoded = decode_all([job.StateCodec.encode_block(records)])
+        self.assertEqual(decoded, records)
+        self.assertEqual(type(decoded[0][0]), tuple)
+        self.assertEqual(type(decoded[0][1]), list)
+
+    def test_integer_key_parts(self):
+        records = [((u'a', 0, None, -1), [1.0]), ((u'b', 1 << 62, u'c', 2 ** 40), [2.0])]
+        self.assertEqual(decode_all([job.StateCodec.encode_block(records)]), records)
+        records = [((i, i * 3), [float(i)]) for i in range(5)]
+        self.assertEqual(decode_all([job.StateCodec.encode_block(records)]), records)
+
+    def test_blocks_split_by_size_and_shape(self):
+        records = [(('a', str(i)), [float(i)]) for i in range(10)] + [((None, 'b', 'c'), [1.0, 2.0]), ((None, 'b', 3), [1.0, 2.0])]
+        blocks = list(job.StateCodec.encode_partition(iter(records)))
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual(decode_all(blocks), records)
+
+        original = job.StateCodec.BLOCK_SIZE
+        job.StateCodec.BLOCK_SIZE = 4
+        try:
+            blocks = list(job.StateCodec.encode_partition(iter(records)))
+        finally:
+            job.StateCodec.BLOCK_SIZE = original
+        self.assertEqual(len(blocks), 5)
+        self.assertEqual(decode_all(blocks), records)
+
+    def test_rejects_mixed_shapes_and_unencodable_parts(self):
+        self.assertRaises(ValueError, job.StateCodec.encode_block, [(('a',), [1.0]), (('a', 'b'), [1.0])])
+        self.assertRaises(ValueError, job.StateCodec.encode_block, [(('a', 1), [1.0]), (('a', 'b'), [1.0])])
+        self.assertRaises(TypeError, job.StateCodec.encode_block, [((u'a\x00b',), [1.0])])
+        self.assertRaises(ValueError, job.StateCodec.decode_block, 'not a block')
+
+class StatePartitionKeyTest(unittest.TestCase):
+
+    def key(self, timespan, tile_id):
+        return ('keyword', 'twitter', u'rain', None, timespan, job.Tile.tile_key_from_tile_id(tile_id))
+
+    def test_partitions_by_timespan_and_zoom_8_ancestor(self):
+        # 15_16000_24000 and 15_16127_24063 lie in 8_125_187, 15_16128_24000 does not
+        self.assertEqual(job.state_partition_key(self.key('week-2016-18', '15_16000_24000')), 'week-2016-18_8_125_187')
+        self.assertEqual(job.state_partition_key(self.key('week-2016-18', '15_16127_24063')), 'week-2016-18_8_125_187')
+        self.assertEqual(job.state_partition_key(self.key('week-2016-18', '15_16128_24000')), 'week-2016-18_8_126_187')
+        self.assertEqual(job.state_partition_key(self.key('alltime', '15_16000_24000')), 'alltime_8_125_187')
+
+    def test_hours_are_grouped_by_day_and_days_by_month(self):
+        self.assertEqual(job.state_partition_key(self.key('hour-2016-05-01-13:00', '15_16000_24000')), 'hour-2016-05-01_8_125_187')
+        self.assertEqual(job.state_partition_key(self.key('hour-2016-05-01-00:00', '15_16000_24000')), 'hour-2016-05-01_8_125_187')
+        self.assertEqual(job.state_partition_key(self.key('day-2016-05-31', '15_16000_24000')), 'day-2016-05_8_125_187')
+        for label in ['alltime', 'year-2016', 'month-2016-05', 'week-2016-18']:
+            self.assertEqual(job.state_timespan_group(label), label)
+
+    def test_coarser_tiles_are_their_own_partition(self):
+        self.assertEqual(job.state_partition_key(self.key('alltime', '5_15_23')), 'alltime_5_15_23')
+
+    def test_timespan_of_a_partition(self):
+        self.assertEqual(job.state_partition_timespan('hour-2016-05-01_8_125_187'), 'hour-2016-05-01')
+        self.assertEqual(job.state_partition_timespan('alltime_5_15_23'), 'alltime')
+
+class GarbageCollectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.data_source = job.FileDataSource()
+
+    def tearDown(self):
+        shutil.rmtree(self.container)
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(folder, name), self.container)
+                      for folder, folders, names in os.walk(self.container) for name in names)
+
+    def commit(self, generation, partitions, retained=2):
+        # a run that wrote the part files of `generation` and kept the rest
+        store = job.tile_state_store(self.data_source, self.container)
+        if not store.is_initialized():
+            store.reset()
+        written = [path for path in partitions.values() if path.startswith(generation + '/')]
+        if written:
+            os.makedirs(os.path.join(self.container, generation))
+            for name in written + [generation + '/_SUCCESS']:
+                open(os.path.join(self.container, name), 'w').close()
+        store.manifest['partitions'] = dict(partitions)
+        store.commit(generation, retained)
+        store.delete_unreferenced()
+        return store
+
+    def test_deletes_the_part_files_of_dropped_generations(self):
+        self.commit('g1', {'a': 'g1/part-00000', 'b': 'g1/part-00001'})
+        self.commit('g2', {'a': 'g2/part-00000', 'b': 'g1/part-00001'})
+        self.assertEqual(self.files(), ['g1/_SUCCESS', 'g1/manifest.json', 'g1/part-00000', 'g1/part-00001',
+                                        'g2/_SUCCESS', 'g2/manifest.json', 'g2/part-00000', 'manifest.json'])
+        # g1 falls out: only g2 referred to its superseded part file
+        self.commit('g3', {'a': 'g3/part-00000', 'b': 'g1/part-00001'})
+        self.assertEqual(self.files(), ['g1/_SUCCESS', 'g1/part-00001',
+                                        'g2/_SUCCESS', 'g2/manifest.json', 'g2/part-00000',
+                                        'g3/_SUCCESS', 'g3/manifest.json', 'g3/part-00000', 'manifest.json'])
+        # g2 falls out with its folder, g1 goes once no generation refers to it
+        self.commit('g4', {'a': 'g4/part-00000', 'b': 'g4/part-00001'})
+        self.assertEqual(self.files(), ['g1/_SUCCESS', 'g1/part-00001',
+                                        'g3/_SUCCESS', 'g3/manifest.json', 'g3/part-00000',
+                                        'g4/_SUCCESS', 'g4/manifest.json', 'g4/part-00000', 'g4/part-00001', 'manifest.json'])
+        self.commit('g5', {'a': 'g4/part-00000', 'b': 'g4/part-00001'})
+        self.assertEqual(self.files(), ['g4/_SUCCESS', 'g4/manifest.json', 'g4/part-00000', 'g4/part-00001',
+                                        'g5/manifest.json', 'manifest.json'])
+
+    def test_rollback_deletes_the_later_generations(self):
+        self.commit('g1', {'a': 'g1/part-00000'}, retained=3)
+        self.commit('g2', {'a': 'g1/part-00000', 'b': 'g2/part-00000'}, retained=3)
+        self.commit('g3', {'a': 'g3/part-00000', 'b': 'g2/part-00000'}, retained=3)
+        job.rollback_state(self.data_source, self.container, 'g1')
+        self.assertEqual(self.files(), ['g1/_SUCCESS', 'g1/manifest.json', 'g1/part-00000', 'manifest.json'])
+
+    def test_sweeps_state_from_before_the_manifest_once(self):
+        os.makedirs(os.path.join(self.container, 'legacy'))
+        open(os.path.join(self.container, 'legacy', 'part-00000'), 'w').close()
+        self.commit('g1', {'a': 'g1/part-00000'})
+        self.assertEqual(self.files(), ['g1/_SUCCESS', 'g1/manifest.json', 'g1/part-00000', 'manifest.json'])
+
+if __name__ == '__main__':
+    unittest.main()
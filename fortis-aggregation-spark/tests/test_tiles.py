@@ -0,0 +1,35 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+class TileKeyTest(unittest.TestCase):
+
+    def test_tile_ids_round_trip(self):
+        for tileId in ['15_16000_24000', '8_125_187', '1_0_1']:
+            self.assertEqual(job.Tile.tile_id_from_tile_key(job.Tile.tile_key_from_tile_id(tileId)), tileId)
+
+    def test_batch_keys_match_the_scalar_keys(self):
+        rng = random.Random(1)
+        points = [(rng.uniform(-85, 85), rng.uniform(-180, 180)) for _ in range(200)] + [(89.9, 0.0), (0.0, 180.0)]
+        latitudes = [latitude for latitude, longitude in points]
+        longitudes = [longitude for latitude, longitude in points]
+        keys = job.Tile.tile_keys_from_lat_long(latitudes, longitudes, job.Tile.MAX_ZOOM)
+        for zoom in [job.Tile.MAX_ZOOM, 15, 8]:
+            ancestors = job.Tile.ancestor_tile_keys(keys, zoom)
+            expected = []
+            for latitude, longitude in points:
+                try:
+                    expected.append(job.Tile.tile_key_from_lat_long(latitude, longitude, zoom))
+                except ValueError:
+                    expected.append(job.Tile.INVALID_TILE_KEY)
+            self.assertEqual(ancestors, expected)
+            # plain ints, never numpy scalars, go into the shuffle keys
+            self.assertEqual(type(ancestors), list)
+            self.assertTrue(all(type(key) in (int, long) for key in ancestors))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import cPickle
+import os
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jobs'))
+import bytileAggregator as job
+
+MESSAGES = [
+    {'Keywords': [u'rain', u'مطر'], 'Sentiment': 0.9},
+    {'Keywords': [u'rain'], 'Sentiment': 0.1},
+    {'Keywords': [u'new york', u'rain']},
+    {'Keywords': [], 'Sentiment': 0.2},
+]
+
+def count(messages):
+    counts = job.KeywordCounts()
+    for message in messages:
+        counts.add(message)
+    return counts
+
+class KeywordCountsTest(unittest.TestCase):
+
+    def test_add(self):
+        counts = count(MESSAGES)
+        self.assertEqual((counts.messages, counts.positives), (4, 2))
+        self.assertEqual(counts.mag, {u'kw-rain': 3, u'kw-مطر': 1, u'kw-new york': 1})
+        self.assertEqual(counts.pos, {u'kw-rain': 2, u'kw-مطر': 1, u'kw-new york': 1})
+
+    def test_merge_is_the_same_as_adding(self):
+        merged = count(MESSAGES[:2]).merge(count(MESSAGES[2:]))
+        self.assertEqual(merged, count(MESSAGES))
+        self.assertEqual(job.KeywordCounts().merge(count(MESSAGES)), count(MESSAGES))
+
+    def test_rows(self):
+        rows = sorted(count(MESSAGES).rows())
+        self.assertEqual(rows, [(None, [4, 2]), (u'kw-new york', [1, 1]), (u'kw-rain', [3, 2]), (u'kw-مطر', [1, 1])])
+        self.assertEqual(list(job.KeywordCounts().rows()), [(None, [0, 0])])
+
+    def test_pickle_round_trip(self):
+        for counts in [count(MESSAGES), count(MESSAGES[1:2]), job.KeywordCounts()]:
+            for dumps, loads in [(cPickle.dumps, cPickle.loads), (pickle.dumps, pickle.loads)]:
+                for protocol in [0, 2]:
+                    restored = loads(dumps(counts, protocol))
+                    self.assertEqual(type(restored), job.KeywordCounts)
+                    self.assertEqual(restored, counts)
+        # keywords without positive messages are not stored in `pos`
+        self.assertEqual(cPickle.loads(cPickle.dumps(count(MESSAGES[1:2]), 2)).pos, {})
+
+    def test_restored_counts_keep_adding(self):
+        restored = cPickle.loads(cPickle.dumps(count(MESSAGES[:2]), 2))
+        restored.add(MESSAGES[2]).merge(count(MESSAGES[3:]))
+        self.assertEqual(restored, count(MESSAGES))
+
+if __name__ == '__main__':
+    unittest.main()